@@ -7,6 +7,11 @@
 #
 
 
+import sys
+
+from tile_grid import TileGrid, TileRenderer
+
+
 #__________________________________________________________________________
 # Utility classes
 
@@ -55,6 +60,10 @@ class Graph:
         # _next[u][v]: u's next vertice on the shortest path from u to v;
         #              for path reconstruction
         self._next = [[-1] * self._nnodes for i in xrange(self._nnodes)]
+        # the shortest path from a vertex to itself is the vertex alone
+        for i in xrange(self._nnodes):
+            self._dist[i][i] = self._node_weights[i]
+            self._next[i][i] = i
 
     def add_edge(self, u, v):
         # we initialize the weight of an edge to the sum of weights of its
@@ -63,10 +72,11 @@ class Graph:
         self._next[u][v] = v
 
     def floyd_warshall(self):
-        # implementation of Floyd-Warshall algorithm 
-        for i in xrange(self._nnodes):
-            for j in xrange(self._nnodes):
-                for k in xrange(self._nnodes):
+        # implementation of Floyd-Warshall algorithm; k, the vertex paths
+        # may go through, _MUST_ be the outermost loop
+        for k in xrange(self._nnodes):
+            for i in xrange(self._nnodes):
+                for j in xrange(self._nnodes):
                     d = self._dist[i][k] + self._dist[k][j] - self._node_weights[k]
                     if d < self._dist[i][j]:
                         self._dist[i][j] = d
@@ -101,6 +111,218 @@ class Graph:
             path.append(u)
         return dist, path
 
+#__________________________________________________________________________
+# class SparseGraph
+#   the same kind of graph as Graph (vertices have weights, the cost of a
+#   path is the sum of the weights of the vertices on it), stored as
+#   adjacency lists so that memory grows with the number of edges.
+#   shortest paths are computed on demand with a heap-based Dijkstra's
+#   algorithm, one source at a time, and paths are reconstructed from the
+#   predecessor arrays it returns.
+#
+
+class SparseGraph:
+    # we assume that nodes are numbered from 0
+    def __init__(self, node_weights, infinity=100000000):
+        self._node_weights = node_weights[:]
+        self._nnodes = len(self._node_weights)
+        self._infinity = infinity
+        self._adj = [[] for i in xrange(self._nnodes)]
+
+    def add_edge(self, u, v):
+        # a directed edge u -> v; parallel edges and loops are dropped as
+        # they never make a path shorter
+        if u != v and v not in self._adj[u]:
+            self._adj[u].append(v)
+
+    def nnodes(self):
+        return self._nnodes
+
+    def weight(self, u):
+        return self._node_weights[u]
+
+    def neighbors(self, u):
+        return self._adj[u]
+
+    def single_source(self, u):
+        # returns dist, pred:
+        #   dist[v]: length of the shortest path from u to v (infinity if v
+        #            can't be reached)
+        #   pred[v]: v's previous vertex on that path (-1 for u and for
+        #            vertices that can't be reached)
+        from heapq import heappush, heappop
+        w = self._node_weights
+        dist = [self._infinity] * self._nnodes
+        pred = [-1] * self._nnodes
+        dist[u] = w[u]
+        heap = [(w[u], u)]
+        while heap:
+            d, x = heappop(heap)
+            if d > dist[x]:
+                continue
+            for y in self._adj[x]:
+                dy = d + w[y]
+                if dy < dist[y]:
+                    dist[y], pred[y] = dy, x
+                    heappush(heap, (dy, y))
+        return dist, pred
+
+    def all_pairs(self):
+        # yields (u, dist, pred) for every vertex u, one source at a time
+        for u in xrange(self._nnodes):
+            dist, pred = self.single_source(u)
+            yield u, dist, pred
+
+    def max_sps(self):
+        # same as Graph.max_sps(), in O(n * m log n) time and O(n + m) space
+        max_, ret = -1, []
+        for u, dist, pred in self.all_pairs():
+            for v, d in enumerate(dist):
+                if d == self._infinity or d < max_:
+                    continue
+                if d > max_:
+                    max_, ret = d, []
+                ret.append(Pair(u, v))
+        return ret
+
+    def shortest_path(self, u, v):
+        # return the length of the shortest path of from u to v and the list
+        # of nodes along the path
+        dist, pred = self.single_source(u)
+        return dist[v], SparseGraph.path_to(v, dist, pred, self._infinity)
+
+    @staticmethod
+    def path_to(v, dist, pred, infinity=100000000):
+        # reconstruct the path to v from the result of single_source()
+        if dist[v] == infinity:
+            return []
+        path = [v]
+        while pred[path[-1]] != -1:
+            path.append(pred[path[-1]])
+        path.reverse()
+        return path
+
+#__________________________________________________________________________
+# class PoiFinder
+#   finds a longest path among the shortest paths between all pairs of
+#   vertices (the diameter) of a SparseGraph whose edges all go both ways,
+#   without computing all pairs:
+#     * if the graph is a tree, the farthest vertex from any vertex is an
+#       endpoint of a diameter, and every vertex is farthest from one of
+#       the two endpoints of a diameter (double sweep)
+#     * otherwise the eccentricity (distance to the farthest vertex) of a
+#       vertex v bounds that of every other vertex w from below and above:
+#         max(d(v,w), ecc(v) - d(v,w) + c(w)) <= ecc(w)
+#         ecc(w) <= d(v,w) + ecc(v) - c(v)
+#       so we run Dijkstra's algorithm from candidate vertices, picked by
+#       their bounds, until no other vertex can beat the best eccentricity
+#       found (Takes and Kosters, "Determining the diameter of small world
+#       networks")
+#   of all pairs (u, v) on a longest path, the smallest one in
+#   lexicographic order is selected, as Graph.max_sps() lists it first.
+#
+
+class PoiFinder:
+    def __init__(self, graph, infinity=100000000):
+        self._graph = graph
+        self._nnodes = graph.nnodes()
+        self._infinity = infinity
+
+    def _dijkstra(self, src):
+        # as SparseGraph.single_source(), with None for no path
+        dist, pred = self._graph.single_source(src)
+        return [None if d == self._infinity else d for d in dist], pred
+
+    def _is_forest(self):
+        adj = [self._graph.neighbors(u) for u in xrange(self._nnodes)]
+        nedges = sum([len(l) for l in adj]) / 2
+        ncomps, seen = 0, [False] * self._nnodes
+        for s in xrange(self._nnodes):
+            if seen[s]:
+                continue
+            ncomps += 1
+            seen[s] = True
+            stack = [s]
+            while stack:
+                u = stack.pop()
+                for v in adj[u]:
+                    if not seen[v]:
+                        seen[v] = True
+                        stack.append(v)
+        return nedges == self._nnodes - ncomps
+
+    def _eccentricities_of_forest(self):
+        # double sweep in every tree of the forest
+        ecc = [None] * self._nnodes
+        for s in xrange(self._nnodes):
+            if ecc[s] is not None:
+                continue
+            dist, pred = self._dijkstra(s)
+            reach = [v for v in xrange(self._nnodes) if dist[v] is not None]
+            a = max(reach, key=lambda v: dist[v])
+            dist_a, pred = self._dijkstra(a)
+            b = max(reach, key=lambda v: dist_a[v])
+            dist_b, pred = self._dijkstra(b)
+            for v in reach:
+                ecc[v] = max(dist_a[v], dist_b[v])
+        return ecc
+
+    def _bound_eccentricities(self):
+        # returns the diameter, and lower and upper bounds of the
+        # eccentricities of all vertices
+        w = [self._graph.weight(u) for u in xrange(self._nnodes)]
+        infinity = float('inf')
+        lower = [-infinity] * self._nnodes
+        upper = [infinity] * self._nnodes
+        candidates = set(xrange(self._nnodes))
+        diameter, pick_upper = -infinity, True
+        while candidates:
+            if pick_upper:
+                v = max(candidates, key=lambda u: (upper[u], -u))
+            else:
+                v = min(candidates, key=lambda u: (lower[u], u))
+            pick_upper = not pick_upper
+
+            dist, pred = self._dijkstra(v)
+            ecc_v = max([d for d in dist if d is not None])
+            diameter = max(diameter, ecc_v)
+            for u, d in enumerate(dist):
+                if d is None:
+                    continue
+                lower[u] = max(lower[u], d, ecc_v - d + w[u])
+                upper[u] = min(upper[u], d + ecc_v - w[v])
+
+            candidates = set([u for u in candidates
+                              if upper[u] > diameter and lower[u] != upper[u]])
+            for u in xrange(self._nnodes):
+                if lower[u] == upper[u]:
+                    diameter = max(diameter, lower[u])
+        return diameter, lower, upper
+
+    def find(self):
+        # returns the length of the longest shortest path and the list of
+        # vertices on it
+        if self._nnodes == 0:
+            return 0, []
+
+        if self._is_forest():
+            ecc = self._eccentricities_of_forest()
+            diameter = max(ecc)
+            lower = upper = ecc
+        else:
+            diameter, lower, upper = self._bound_eccentricities()
+
+        # the first u with ecc(u) == diameter, and the first v farthest
+        # from it
+        for u in xrange(self._nnodes):
+            if upper[u] < diameter:
+                continue
+            dist, pred = self._graph.single_source(u)
+            if diameter not in dist:
+                continue
+            v = dist.index(diameter)
+            return diameter, SparseGraph.path_to(v, dist, pred, self._infinity)
+
 #__________________________________________________________________________
 # class Dungeon
 #
@@ -152,6 +374,9 @@ class Dungeon:
     TILE_DOOR = 0x08
     TILE_MARK = 0x10
 
+    _RENDERER = TileRenderer({TILE_MARK: '.', TILE_ROOM: '+', TILE_CORR: ' ',
+                              TILE_ROCK: '#', TILE_DOOR: 'x'})
+
     def __init__(self):
         self._rep = None    # representation of the map
         self._id = None     # id of each tile on the map
@@ -161,23 +386,16 @@ class Dungeon:
         self._room_wrange = Pair(3, 6)  # [) range of witdh of rooms
         self._room_hrange = Pair(3, 6)  # [) range of height of rooms 
         self._rooms = None
+        self._dead_ends_removed = 0 # number of dead end tiles removed
 
     def set_geometry(self, width, height):
         # the width and the height of the map _MUST_ be odd
         assert width % 2 == 1
         assert height % 2 == 1
-        assert width <= 201
-        assert height <= 201
 
         self._width = width
         self._height = height
 
-        # we prevent our program from a stack overflow in case of large
-        # recursion depths
-        import sys
-        limit = max(self._width * self._height, sys.getrecursionlimit())
-        sys.setrecursionlimit(limit)
-
     def set_attempts(self, attempts):
         self._attempts = attempts
 
@@ -193,35 +411,40 @@ class Dungeon:
     def get_rep(self):
         return self._rep
 
+    def get_dead_ends_removed(self):
+        # the number of dead end tiles the last generate() removed
+        return self._dead_ends_removed
+
     def print_(self):
         if not self._rep:
             raise Exception('You _SHOULD_ call generate() first')
 
-        def __symbol(type):
-            if type == Dungeon.TILE_MARK:
-                return '.'
-            if type == Dungeon.TILE_ROOM:
-                return '+'
-            if type == Dungeon.TILE_CORR:
-                return ' '
-            if type == Dungeon.TILE_ROCK:
-                return '#'
-            if type == Dungeon.TILE_DOOR:
-                return 'x'
-            raise Exception('Undefined dungeon tile')
+        self.write_to(sys.stdout)
+        print
 
-        output = ''
-        for y in xrange(self._height):
-            for x in xrange(self._width):
-                output += __symbol(self._rep[y][x])
-            output += '\n'
+    def write_to(self, fileobj):
+        # write the map out as text, a row at a time
+        if not self._rep:
+            raise Exception('You _SHOULD_ call generate() first')
+        Dungeon._RENDERER.write_to(self._rep, fileobj)
 
-        print output
+    def save(self, path, seed=None):
+        # write the map, with the room and maze id of every tile as plane
+        # 'id', to a binary map file (see map_file.py)
+        if not self._rep:
+            raise Exception('You _SHOULD_ call generate() first')
+        from map_file import write_map
+        params = {'width': self._width, 'height': self._height,
+                  'attempts': self._attempts,
+                  'room_wrange': [self._room_wrange.first, self._room_wrange.second],
+                  'room_hrange': [self._room_hrange.first, self._room_hrange.second]}
+        write_map(path, self._rep, [('id', self._id)], 'bob_dungeon', seed, params)
 
     def generate(self):
         # generate a dungeon
-        self._rep = [[Dungeon.TILE_ROCK] * self._width for i in xrange(self._height)]
-        self._id = [[0] * self._width for i in xrange(self._height)]
+        self._rep = TileGrid(self._width, self._height, Dungeon.TILE_ROCK)
+        self._id = TileGrid(self._width, self._height, 0,
+                            TileGrid.typecode_for(self._width * self._height))
 
         # place a bunch of random non-overlapping rooms on the map
         self._place_rooms()
@@ -235,19 +458,29 @@ class Dungeon:
 
         # remove all of the dead ends. a dead end is a corridor position or a
         # door position with 3 rock neighbors
-        self._remove_dead_ends()
+        self._dead_ends_removed = self._remove_dead_ends()
 
     def _place_rooms(self):
         
         #  generate a bunch of randomly located, non-overlapping rooms
+
+        # use odd sizes and positions for rooms so they can be aligned with
+        # the mazes
+        xs = self._filter_odds(Pair(1, self._width - 1))
+        ys = self._filter_odds(Pair(1, self._height - 1))
+        ws = self._filter_odds(self._room_wrange)
+        hs = self._filter_odds(self._room_hrange)
+
+        # occupied[y] is a bitmask of the tiles in row y covered by rooms
+        # placed so far
+        occupied = [0] * self._height
+
         rooms = []
         for i in xrange(self._attempts):
-            room = self._rand_room(Pair(1, self._width - 1),
-                             Pair(1, self._height - 1),
-                             self._room_wrange,
-                             self._room_hrange)
-            if not self._valid_room(room, rooms):
+            room = self._rand_room(xs, ys, ws, hs)
+            if not self._valid_room(room, occupied):
                 continue
+            self._occupy(room, occupied)
             rooms.append(room)
 
         print 'Number of Rooms: %d' % len(rooms)
@@ -265,31 +498,32 @@ class Dungeon:
             room_id = i + room_id_base
             
             # draw the room on the map 
-            for y in xrange(room.y, room.y + room.height):
-                for x in xrange(room.x, room.x + room.width):
-                    self._rep[y][x] = Dungeon.TILE_ROOM
-                    self._id[y][x] = room_id
-                    
-            self._rooms.append(room)
+            self._rep.fill_rect(room.x, room.y, room.width, room.height, Dungeon.TILE_ROOM)
+            self._id.fill_rect(room.x, room.y, room.width, room.height, room_id)
 
-    def _rand_room(self, x_range, y_range, w_range, h_range):
-        # generate a randomly placed and randomly sized room
-        from random import randint
+            self._rooms.append(room)
 
-        def __filter_odds(rg):
-            return [x for x in xrange(rg.first, rg.second) if x % 2 != 0]
+    @staticmethod
+    def _filter_odds(rg):
+        return [x for x in xrange(rg.first, rg.second) if x % 2 != 0]
 
-        # use odd sizes and positions for rooms so they can be aligned with
-        # the mazes
-        xs, ys = __filter_odds(x_range), __filter_odds(y_range)
-        ws, hs = __filter_odds(w_range), __filter_odds(h_range)
+    def _rand_room(self, xs, ys, ws, hs):
+        # generate a randomly placed and randomly sized room, picking its
+        # position and size from the given lists
+        from random import randint
 
         return Rect(xs[randint(0, len(xs)-1)],
                     ys[randint(0, len(ys)-1)],
                     ws[randint(0, len(ws)-1)],
                     hs[randint(0, len(hs)-1)])
 
-    def _valid_room(self, room, rooms):
+    @staticmethod
+    def _room_mask(room):
+        # Rect.overlaps treats rooms as closed rectangles, so a room covers
+        # columns x .. x + width inclusive
+        return ((1 << (room.width + 1)) - 1) << room.x
+
+    def _valid_room(self, room, occupied):
 
         # test if the position is out of range
         if room.x + room.width > self._width - 1:
@@ -297,12 +531,20 @@ class Dungeon:
         if room.y + room.height > self._height - 1:
             return False
 
-        # test if the room overlaps other rooms already placed
-        for other in rooms:
-            if room.overlaps(other):
+        # test if the room overlaps other rooms already placed. two closed
+        # rectangles overlap iff they share a tile, so we only look at the
+        # rows covered by the room
+        mask = self._room_mask(room)
+        for y in xrange(room.y, room.y + room.height + 1):
+            if occupied[y] & mask:
                 return False
         return True
 
+    def _occupy(self, room, occupied):
+        mask = self._room_mask(room)
+        for y in xrange(room.y, room.y + room.height + 1):
+            occupied[y] |= mask
+
     def _place_corrs(self):
         # generate mazes and place them
         maze_id = len(self._rooms)
@@ -314,9 +556,6 @@ class Dungeon:
     def _aux_place_corrs(self, prev, curr, id):
         if not self._valid_corr_pos(prev, curr):
             return False
-        x, y = curr.first, curr.second
-        self._rep[y][x] = Dungeon.TILE_CORR
-        self._id[y][x] = id
 
         #  after placing a corridor, there are four cases facing us:
         # 
@@ -333,18 +572,38 @@ class Dungeon:
         #  position 'x' is also a rock, we can place the next corridor
         #  at 'x' and continue depth-first searching
         #
+        #  the search keeps its own stack of [x, y, shuffled directions,
+        #  number of directions tried] instead of recursing, and visits
+        #  positions in the same order as the recursive version did
 
         rx1, rx2 = [-2, 1, -1, -1], [0, 3, 2, 2]
         ry1, ry2 = [-1, -1, -2, 1], [2, 2, 0, 3]
         dx, dy = [-1, 1, 0, 0], [0, 0, -1, 1]
 
         from random import shuffle
-        directions = [0, 1, 2, 3]
-        shuffle(directions)  # shuffling the directions
-        for d in directions:
+
+        def __place(pos):
+            x, y = pos.first, pos.second
+            self._rep.set(x, y, Dungeon.TILE_CORR)
+            self._id.set(x, y, id)
+            directions = [0, 1, 2, 3]
+            shuffle(directions)  # shuffling the directions
+            return [x, y, directions, 0]
+
+        stack = [__place(curr)]
+        while stack:
+            frame = stack[-1]
+            x, y, directions, tried = frame
+            if tried == len(directions):
+                stack.pop()
+                continue
+            d = directions[tried]
+            frame[3] += 1
             if self._count_rocks(Pair(x + rx1[d], x + rx2[d]),
                                  Pair(y + ry1[d], y + ry2[d])) == 6:
-                self._aux_place_corrs(curr, Pair(x + dx[d], y + dy[d]), id)
+                next_ = Pair(x + dx[d], y + dy[d])
+                if self._valid_corr_pos(Pair(x, y), next_):
+                    stack.append(__place(next_))
         return True
 
     def _valid_pos(self, x, y):
@@ -358,7 +617,7 @@ class Dungeon:
         x, y = curr.first, curr.second
         if not self._valid_pos(x, y):
             return False
-        if self._rep[y][x] != Dungeon.TILE_ROCK:
+        if self._rep.get(x, y) != Dungeon.TILE_ROCK:
             return False
         # we start BFS from a rock surrounded by 8 rocks
         if prev is None and self._count_surr_rocks(x, y) != 8:
@@ -372,7 +631,7 @@ class Dungeon:
             for dx in xrange(-1, 2):
                 if dx == 0 and dy == 0:
                     continue
-                if self._rep[y+dy][x+dx] == Dungeon.TILE_ROCK:
+                if self._rep.get(x+dx, y+dy) == Dungeon.TILE_ROCK:
                     count += 1
         return count
 
@@ -383,7 +642,7 @@ class Dungeon:
             for x in xrange(x_range.first, x_range.second):
                 if x < 0 or x >= self._width or y < 0 or y >= self._height:
                     continue
-                if self._rep[y][x] == Dungeon.TILE_ROCK:
+                if self._rep.get(x, y) == Dungeon.TILE_ROCK:
                     count += 1
         return count
 
@@ -392,20 +651,28 @@ class Dungeon:
         # find all connectors. connectors are tiles that are:
         #  1. solid rock
         #  2. adjacent to two rooms or a room and a corridor.
-        
+        #
+        # each row is compared against shifted copies of itself and of its
+        # neighbor rows, so connectors come out in row-major order
+
+        from operator import or_
+
+        ROCK = Dungeon.TILE_ROCK
+        comp_types = (Dungeon.TILE_CORR | Dungeon.TILE_ROOM, Dungeon.TILE_ROOM)
+
         connectors = []
         for y in xrange(1, self._height-1):
-            for x in xrange(1, self._width-1):
-                if self._rep[y][x] != Dungeon.TILE_ROCK:
-                    continue
-                comp_type1 = Dungeon.TILE_CORR | Dungeon.TILE_ROOM
-                comp_type2 = Dungeon.TILE_ROOM
-                comp1 = self._rep[y][x-1] | self._rep[y][x+1]
-                comp2 = self._rep[y-1][x] | self._rep[y+1][x]
-                if comp1 == comp_type1 or comp1 == comp_type2:
-                    connectors.append((x, y, self._id[y][x-1], self._id[y][x+1]))
-                elif comp2 == comp_type1 or comp2 == comp_type2:
-                    connectors.append((x, y, self._id[y-1][x], self._id[y+1][x]))
+            up, mid, down = [self._rep.get_row(y + dy) for dy in (-1, 0, 1)]
+            comp1 = map(or_, mid[:-2], mid[2:])   # left | right of x = i+1
+            comp2 = map(or_, up[1:-1], down[1:-1]) # above | below of x = i+1
+            ids = self._id.get_row(y)
+            for i in [i for i, t in enumerate(mid[1:-1]) if t == ROCK and
+                      (comp1[i] in comp_types or comp2[i] in comp_types)]:
+                x = i + 1
+                if comp1[i] in comp_types:
+                    connectors.append((x, y, ids[x-1], ids[x+1]))
+                else:
+                    connectors.append((x, y, self._id.get(x, y-1), self._id.get(x, y+1)))
 
         # the basic idea for placing doors is placing doors at connector
         # positions that help form a spanning tree in which nodes are rooms
@@ -414,17 +681,30 @@ class Dungeon:
 
     def _do_place_doors(self, connectors):
 
-        # we use union-find data structure to construct a spanning tree
-        max_id = max([max(row) for row in self._id])
-        L = [i for i in range(0, max_id + 1)]
+        # we use union-find data structure (union by rank, path compression)
+        # to construct a spanning tree. only ids found at connectors are
+        # ever looked up
+        max_id = max([max(c[2], c[3]) for c in connectors] or [0])
+        L = range(0, max_id + 1)
+        rank = [0] * (max_id + 1)
 
         def __union(x, y):
-            L[__find(x)] = __find(y)
+            x, y = __find(x), __find(y)
+            if rank[x] < rank[y]:
+                L[x] = y
+            elif rank[x] > rank[y]:
+                L[y] = x
+            else:
+                L[x] = y
+                rank[y] += 1
 
         def __find(x):
-            if L[x] != x:
-                L[x] = __find(L[x])
-            return L[x]
+            root = x
+            while L[root] != root:
+                root = L[root]
+            while L[x] != root:
+                L[x], x = root, L[x]
+            return root
 
         from random import random
         from random import shuffle
@@ -434,10 +714,10 @@ class Dungeon:
                 # we allow two or more doors between two regions with a slight
                 # chance 
                 if random() < 0.01 and self._count_neighbor_doors(x, y) == 0:
-                    self._rep[y][x] = Dungeon.TILE_DOOR
+                    self._rep.set(x, y, Dungeon.TILE_DOOR)
             else:
                 __union(id1, id2)
-                self._rep[y][x] = Dungeon.TILE_DOOR
+                self._rep.set(x, y, Dungeon.TILE_DOOR)
 
         # shuffling for randomness
         shuffle(connectors)
@@ -447,51 +727,72 @@ class Dungeon:
     def _count_neighbor_doors(self, x, y):
         # count doors in neighbor positions
         count = 0
-        if self._rep[y-1][x] == Dungeon.TILE_DOOR:
+        if self._rep.get(x, y-1) == Dungeon.TILE_DOOR:
             count += 1
-        if self._rep[y+1][x] == Dungeon.TILE_DOOR:
+        if self._rep.get(x, y+1) == Dungeon.TILE_DOOR:
             count += 1
-        if self._rep[y][x-1] == Dungeon.TILE_DOOR:
+        if self._rep.get(x-1, y) == Dungeon.TILE_DOOR:
             count += 1
-        if self._rep[y][x+1] == Dungeon.TILE_DOOR:
+        if self._rep.get(x+1, y) == Dungeon.TILE_DOOR:
             count += 1
         return count
 
     def _remove_dead_ends(self):
-        # remove all dead ends
-        for y in xrange(1, self._height - 1):
-            for x in xrange(1, self._width - 1):
-                self._aux_remove_dead_ends(x, y)
-
-    def _aux_remove_dead_ends(self, x, y):
-        if not self._is_dead_end(x, y):
-            return
-        self._rep[y][x] = Dungeon.TILE_ROCK
-        self._id[y][x] = 0
-        self._aux_remove_dead_ends(x-1, y)
-        self._aux_remove_dead_ends(x+1, y)
-        self._aux_remove_dead_ends(x, y-1)
-        self._aux_remove_dead_ends(x, y+1)
-
-    def _is_dead_end(self, x, y):
-        if not self._valid_pos(x, y):
-            return False
-        if self._rep[y][x] != Dungeon.TILE_CORR and \
-                self._rep[y][x] != Dungeon.TILE_DOOR:
-            return False
-        if self._count_neighbors_not_rock(x, y) != 1:
-            return False
-        return True
+        # remove all dead ends and return the number of tiles removed
+        #
+        # deg[y][x] is the number of non-rock neighbors of (x, y). removing a
+        # dead end only lowers the degree of its neighbors, so a tile can
+        # only become a dead end when its degree falls to 1. the dead ends
+        # already on the map are popped in row-major order, and a tile that
+        # becomes a dead end is popped right after the tile whose removal
+        # made it one, which removes tiles in the same order as scanning the
+        # map row by row and following each chain of dead ends
+        from operator import add
+
+        ROCK = Dungeon.TILE_ROCK
+        PASSAGE = Dungeon.TILE_CORR | Dungeon.TILE_DOOR
+        width, height = self._width, self._height
+
+        open_ = [[int(t != ROCK) for t in self._rep.get_row(y)]
+                 for y in xrange(height)]
+        deg = [[0] * width]
+        for y in xrange(1, height - 1):
+            row = open_[y]
+            horz = map(add, [0] + row[:-1], row[1:] + [0])
+            deg.append(map(add, horz, map(add, open_[y-1], open_[y+1])))
+        deg.append([0] * width)
+
+        ends = []
+        for y in xrange(1, height - 1):
+            rep, d = self._rep.get_row(y), deg[y]
+            ends.extend((x, y) for x in xrange(1, width - 1)
+                        if d[x] == 1 and rep[x] & PASSAGE)
+        ends.reverse()
+
+        removed = 0
+        while ends:
+            x, y = ends.pop()
+            if deg[y][x] != 1 or not self._rep.get(x, y) & PASSAGE:
+                continue  # removed already, or cut off from everything
+            self._rep.set(x, y, ROCK)
+            self._id.set(x, y, 0)
+            removed += 1
+            for nx, ny in ((x-1, y), (x+1, y), (x, y-1), (x, y+1)):
+                deg[ny][nx] -= 1
+                if deg[ny][nx] == 1 and self._rep.get(nx, ny) & PASSAGE:
+                    ends.append((nx, ny))
+
+        return removed
 
     def _count_neighbors_not_rock(self, x, y):
         count = 0
-        if self._rep[y-1][x] != Dungeon.TILE_ROCK:
+        if self._rep.get(x, y-1) != Dungeon.TILE_ROCK:
             count += 1
-        if self._rep[y+1][x] != Dungeon.TILE_ROCK:
+        if self._rep.get(x, y+1) != Dungeon.TILE_ROCK:
             count += 1
-        if self._rep[y][x-1] != Dungeon.TILE_ROCK:
+        if self._rep.get(x-1, y) != Dungeon.TILE_ROCK:
             count += 1
-        if self._rep[y][x+1] != Dungeon.TILE_ROCK:
+        if self._rep.get(x+1, y) != Dungeon.TILE_ROCK:
             count += 1
         return count
     
@@ -530,7 +831,7 @@ class Dungeon:
         visited = [[-1] * self._width for i in xrange(self._height)]
         for y in xrange(1, self._height - 1):
             for x in xrange(1, self._width - 1):
-                if visited[y][x] == -1 and self._rep[y][x] == self.TILE_DOOR:
+                if visited[y][x] == -1 and self._rep.get(x, y) == self.TILE_DOOR:
                     self._collect_graph_info(x, y, -1, nodes, edges, visited)
 
         print 'Number of nodes:', len(nodes)
@@ -558,24 +859,18 @@ class Dungeon:
         for edge in edges:
             print '%2d -> %2d' % (edge.first+1, edge.second+1)
         '''
-        # graph initialization
+        # find a longest path among the shortest paths of all pairs
         node_weights = [node.weight for node in nodes]
-        graph = Graph(node_weights)
+        graph = SparseGraph(node_weights)
         for edge in edges:
             u, v = edge.first, edge.second
             graph.add_edge(u, v)
             graph.add_edge(v, u)
+        dist, path = PoiFinder(graph).find()
 
-        # run Floyd-Warshall algorithm
-        graph.floyd_warshall()
-
-        # get endpoints of the longest paths among shortest paths of all pairs
-        pairs = graph.max_sps()
-
-        assert len(pairs) > 0
+        assert len(path) > 0
 
-        # we select one 'longest path' and mark it out on the map
-        dist, path = graph.shortest_path(pairs[0].first, pairs[0].second)
+        # mark the 'longest path' out on the map
         print 'Dist:', dist
         for u in path:
             node = nodes[u]
@@ -583,16 +878,29 @@ class Dungeon:
             if node.type == node.TYPE_CORR or node.type == node.TYPE_BRCH:
                 for p in node.path:
                     x, y = p.first, p.second
-                    self._rep[y][x] = Dungeon.TILE_MARK
+                    self._rep.set(x, y, Dungeon.TILE_MARK)
 
     def _collect_graph_info(self, x, y, prev_id, nodes, edges, visited):
+        # depth-first traversal of the dungeon from (x, y). a position is
+        # checked when it is popped, and the positions to continue from are
+        # pushed in reverse order, which visits positions (and numbers
+        # nodes) in the same order as a recursive traversal
+        stack = [(x, y, prev_id)]
+        while stack:
+            x, y, prev_id = stack.pop()
+            next_ = self._collect_graph_node(x, y, prev_id, nodes, edges, visited)
+            next_.reverse()
+            stack += next_
+
+    def _collect_graph_node(self, x, y, prev_id, nodes, edges, visited):
+        # returns the list of (x, y, prev_id) to continue the traversal from
         if not self._valid_pos(x, y):
-            return
+            return []
         if visited[y][x] != -1:  # we encounter a position visited
             if prev_id != -1 and prev_id != visited[y][x]:
                 # edge: prev_id -> visited[y][x] 
                 edges.append(Pair(prev_id, visited[y][x]))
-            return
+            return []
 
         curr_id = len(nodes)
         if prev_id != -1:
@@ -600,24 +908,22 @@ class Dungeon:
             # be an edge between node prev_id and node curr_id
             edges.append(Pair(prev_id, curr_id))
 
-        if self._rep[y][x] == self.TILE_ROOM:
+        if self._rep.get(x, y) == self.TILE_ROOM:
             # we encounter a room node 
-            room_id = self._id[y][x]
+            room_id = self._id.get(x, y)
             room = self._rooms[room_id]
             nodes.append(Dungeon._Node(Dungeon._Node.TYPE_ROOM, room.area(), [Pair(room.x, room.y)]))
 
             doors = self._find_doors_of_room(x, y, curr_id, visited)
             # we select a door of the room and continue our traversal
-            for door in doors:
-                d_x, d_y = door.first, door.second
-                self._collect_graph_info(d_x, d_y, curr_id, nodes, edges, visited)
+            return [(door.first, door.second, curr_id) for door in doors]
 
-        elif self._rep[y][x] == self.TILE_DOOR:
+        elif self._rep.get(x, y) == self.TILE_DOOR:
             # we encounter a door node
             nodes.append(Dungeon._Node(Dungeon._Node.TYPE_DOOR, 1, [Pair(x, y)]))
             visited[y][x] = curr_id
 
-            self._aux_collect_graph_info(x, y, curr_id, nodes, edges, visited)
+            return self._aux_collect_graph_info(x, y, curr_id)
 
         elif self._is_branching_point(x, y):
             # we encounter a branching point. a branching point a corridor
@@ -626,70 +932,80 @@ class Dungeon:
             nodes.append(Dungeon._Node(Dungeon._Node.TYPE_BRCH, 1, [Pair(x, y)]))
             visited[y][x] = curr_id
             
-            self._aux_collect_graph_info(x, y, curr_id, nodes, edges, visited)
+            return self._aux_collect_graph_info(x, y, curr_id)
 
-        elif self._rep[y][x] == self.TILE_CORR:
+        elif self._rep.get(x, y) == self.TILE_CORR:
             # we encounter a region of corridors
             corrs = self._collect_corrs(x, y, curr_id, visited)
             assert len(corrs) > 0
             nodes.append(Dungeon._Node(Dungeon._Node.TYPE_CORR, len(corrs), corrs))
 
             last_x, last_y = corrs[-1].first, corrs[-1].second
-            self._aux_collect_graph_info(last_x, last_y, curr_id, nodes, edges, visited)
-
-    def _aux_collect_graph_info(self, x, y, curr_id, nodes, edges, visited):
-        if self._rep[y-1][x] != self.TILE_ROCK:
-            self._collect_graph_info(x, y-1, curr_id, nodes, edges, visited)
-        if self._rep[y+1][x] != self.TILE_ROCK:
-            self._collect_graph_info(x, y+1, curr_id, nodes, edges, visited)
-        if self._rep[y][x-1] != self.TILE_ROCK:
-            self._collect_graph_info(x-1, y, curr_id, nodes, edges, visited)
-        if self._rep[y][x+1] != self.TILE_ROCK:
-            self._collect_graph_info(x+1, y, curr_id, nodes, edges, visited)
+            return self._aux_collect_graph_info(last_x, last_y, curr_id)
+
+        return []
+
+    def _aux_collect_graph_info(self, x, y, curr_id):
+        ret = []
+        if self._rep.get(x, y-1) != self.TILE_ROCK:
+            ret.append((x, y-1, curr_id))
+        if self._rep.get(x, y+1) != self.TILE_ROCK:
+            ret.append((x, y+1, curr_id))
+        if self._rep.get(x-1, y) != self.TILE_ROCK:
+            ret.append((x-1, y, curr_id))
+        if self._rep.get(x+1, y) != self.TILE_ROCK:
+            ret.append((x+1, y, curr_id))
+        return ret
 
     def _is_branching_point(self, x, y):
         if not self._valid_pos(x, y):
             return False
-        if self._rep[y][x] != Dungeon.TILE_CORR:
+        if self._rep.get(x, y) != Dungeon.TILE_CORR:
             return False
         if self._count_neighbors_not_rock(x, y) < 3:
             return False
         return True
 
     def _find_doors_of_room(self, x, y, curr_id, visited):
-        if not self._valid_pos(x, y):
-            return []
-        if visited[y][x] != -1:
-            return []
-        if self._rep[y][x] == self.TILE_ROCK:
-            return []
-        if self._rep[y][x] == self.TILE_DOOR:
-            return [Pair(x, y)]
-
-        visited[y][x] = curr_id
+        # doors are listed in the order a depth-first search going left,
+        # right, up and down meets them
         ret = []
-        ret += self._find_doors_of_room(x-1, y, curr_id, visited)
-        ret += self._find_doors_of_room(x+1, y, curr_id, visited)
-        ret += self._find_doors_of_room(x, y-1, curr_id, visited)
-        ret += self._find_doors_of_room(x, y+1, curr_id, visited)
+        stack = [(x, y)]
+        while stack:
+            x, y = stack.pop()
+            if not self._valid_pos(x, y):
+                continue
+            if visited[y][x] != -1:
+                continue
+            if self._rep.get(x, y) == self.TILE_ROCK:
+                continue
+            if self._rep.get(x, y) == self.TILE_DOOR:
+                ret.append(Pair(x, y))
+                continue
+
+            visited[y][x] = curr_id
+            stack += [(x, y+1), (x, y-1), (x+1, y), (x-1, y)]
         return ret
 
     def _collect_corrs(self, x, y, curr_id, visited):
-        if not self._valid_pos(x, y):
-            return []
-        if visited[y][x] != -1:
-            return []
-        if self._rep[y][x] != Dungeon.TILE_CORR:
-            return []
-        if self._is_branching_point(x, y):
-            return []
+        # corridors are listed in the order a depth-first search going left,
+        # right, up and down meets them
+        ret = []
+        stack = [(x, y)]
+        while stack:
+            x, y = stack.pop()
+            if not self._valid_pos(x, y):
+                continue
+            if visited[y][x] != -1:
+                continue
+            if self._rep.get(x, y) != Dungeon.TILE_CORR:
+                continue
+            if self._is_branching_point(x, y):
+                continue
 
-        visited[y][x] = curr_id
-        ret = [Pair(x, y)]
-        ret += self._collect_corrs(x-1, y, curr_id, visited)
-        ret += self._collect_corrs(x+1, y, curr_id, visited)
-        ret += self._collect_corrs(x, y-1, curr_id, visited)
-        ret += self._collect_corrs(x, y+1, curr_id, visited)
+            visited[y][x] = curr_id
+            ret.append(Pair(x, y))
+            stack += [(x, y+1), (x, y-1), (x+1, y), (x-1, y)]
         return ret
 
 #__________________________________________________________________________
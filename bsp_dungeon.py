@@ -6,6 +6,11 @@
 #  
 
 
+import sys
+
+from tile_grid import TileGrid, TileRenderer
+
+
 #__________________________________________________________________________
 # Code for debugging
 
@@ -37,6 +42,9 @@ class Dungeon:
     TILE_CORR = 0x04  # corridors
     TILE_DOOR = 0x08
 
+    _RENDERER = TileRenderer({TILE_ROOM: '+', TILE_CORR: ' ', TILE_ROCK: '#',
+                              TILE_DOOR: 'x'})
+
     def __init__(self):
         self._width = 80
         self._height = 24
@@ -51,7 +59,7 @@ class Dungeon:
         self._room_mxw = -1       # max width  ..
         self._room_mxh = -1       # max height ..
 
-        self._rep = None          # two-dimensional matrix that represents a generated dungeon
+        self._rep = None          # TileGrid that represents a generated dungeon
 
 
     def set_geometry(self, width, height):
@@ -75,7 +83,7 @@ class Dungeon:
         self._room_mnh, self._room_mxh = mnh, mxh
 
     def generate(self):
-        self._rep = [[Dungeon.TILE_ROCK] * self._width for i in xrange(self._height)]
+        self._rep = TileGrid(self._width, self._height, Dungeon.TILE_ROCK)
 
         self._nnodes = 1 << self._level
         self._bsp_tree = [None] * self._nnodes
@@ -164,9 +172,7 @@ class Dungeon:
         # update _regions for leaf nodes
         self._regions[node_idx] = Rect(x, y, w, h)
 
-        for i in xrange(y, y + h):
-            for j in xrange(x, x + w):
-                self._rep[i][j] = Dungeon.TILE_ROOM
+        self._rep.fill_rect(x, y, w, h, Dungeon.TILE_ROOM)
 
         return True
 
@@ -236,25 +242,25 @@ class Dungeon:
     def _aux_place_corrs_between_points(self, x1, y1, x2, y2, dir):
         if dir == 3: # down
             while y1 < y2:
-                self._rep[y1][x1] = Dungeon.TILE_CORR
+                self._rep.set(x1, y1, Dungeon.TILE_CORR)
                 y1 += 1
             while x1 >= x2: # left
-                self._rep[y1][x1] = Dungeon.TILE_CORR
+                self._rep.set(x1, y1, Dungeon.TILE_CORR)
                 x1 -= 1
         elif dir == 0: # right
             while x1 < x2:
-                self._rep[y1][x1] = Dungeon.TILE_CORR
+                self._rep.set(x1, y1, Dungeon.TILE_CORR)
                 x1 += 1
             while y1 <= y2: # down
-                self._rep[y1][x1] = Dungeon.TILE_CORR
+                self._rep.set(x1, y1, Dungeon.TILE_CORR)
                 y1 += 1
         else:
             raise Exception('Wrong Arguments')
 
     def _aux_place_corrs_dir(self, x, y, dir):
         dx, dy = [1, 0, -1, 0], [0, -1, 0, 1]
-        while self._rep[y][x] == Dungeon.TILE_ROCK:
-            self._rep[y][x] = Dungeon.TILE_CORR
+        while self._rep.get(x, y) == Dungeon.TILE_ROCK:
+            self._rep.set(x, y, Dungeon.TILE_CORR)
             x += dx[dir]
             y += dy[dir]
 
@@ -269,24 +275,25 @@ class Dungeon:
         if not self._rep:
             raise Exception('You _SHOULD_ call generate() first')
 
-        def __symbol(type):
-            if type == Dungeon.TILE_ROOM:
-                return '+'
-            if type == Dungeon.TILE_CORR:
-                return ' '
-            if type == Dungeon.TILE_ROCK:
-                return '#'
-            if type == Dungeon.TILE_DOOR:
-                return 'x'
-            raise Exception('Undefined dungeon tile')
-
-        output = ''
-        for y in xrange(self._height):
-            for x in xrange(self._width):
-                output += __symbol(self._rep[y][x])
-            output += '\n'
-
-        print output
+        self.write_to(sys.stdout)
+        print
+
+    def write_to(self, fileobj):
+        # write the dungeon out as text, a row at a time
+        if not self._rep:
+            raise Exception('You _SHOULD_ call generate() first')
+        Dungeon._RENDERER.write_to(self._rep, fileobj)
+
+    def save(self, path, seed=None):
+        # write the dungeon to a binary map file (see map_file.py)
+        if not self._rep:
+            raise Exception('You _SHOULD_ call generate() first')
+        from map_file import write_map
+        params = {'width': self._width, 'height': self._height,
+                  'level': self._level,
+                  'roomsz': [[self._room_mnw, self._room_mxw],
+                             [self._room_mnh, self._room_mxh]]}
+        write_map(path, self._rep, (), 'bsp_dungeon', seed, params)
 
 #_________________________________________________________________________
 # Code for Testing
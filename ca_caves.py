@@ -10,76 +10,299 @@
 
 import sys, os
 
+from tile_grid import TileGrid, TileRenderer
+
 
 class GenerationRule:
-    def __init__(self, r1_cutoff, r2_cutoff, reps):
+    # W'(p) = R[1](p) >= r1_cutoff || R[2](p) <= r2_cutoff || ...
+    #
+    #   R[n](p) is the number of walls in the (2n+1)x(2n+1) block around p,
+    #   without the four corners of the block when n >= 2. cutoffs gives
+    #   further terms of the rule as (n, op, cutoff) tuples where op is
+    #   AT_LEAST or AT_MOST; r1_cutoff or r2_cutoff may be None to leave
+    #   R[1] or R[2] out of the rule
+
+    AT_LEAST = '>='
+    AT_MOST  = '<='
+
+    def __init__(self, r1_cutoff, r2_cutoff, reps, cutoffs=()):
         self.r1_cutoff = r1_cutoff
         self.r2_cutoff = r2_cutoff
         self.reps = reps
+        self.extra_cutoffs = list(cutoffs)
+        for radius, op, cutoff in self.extra_cutoffs:
+            assert radius >= 1
+            assert op in (GenerationRule.AT_LEAST, GenerationRule.AT_MOST)
+
+    def cutoffs(self):
+        # returns all terms of the rule as a list of (n, op, cutoff)
+        ret = []
+        if self.r1_cutoff is not None:
+            ret.append((1, GenerationRule.AT_LEAST, self.r1_cutoff))
+        if self.r2_cutoff is not None:
+            ret.append((2, GenerationRule.AT_MOST, self.r2_cutoff))
+        return ret + self.extra_cutoffs
+
+    def __str__(self):
+        return ' || '.join(['R[%d](p) %s %d' % term for term in self.cutoffs()])
+
+
+def rand_bits(rng, nbits, fill_prob, precision=32):
+    # returns an integer of nbits random bits, each of which is set with
+    # probability fill_prob (rounded to a multiple of 2^-precision).
+    #
+    #   bit x is set iff a uniform random fraction 0.r1r2...rk (k being the
+    #   precision) is less than fill_prob = 0.b1b2...bk. the comparison is
+    #   done digit by digit from rk up to r1 for all bits at once, with
+    #   digit i of every bit drawn as one getrandbits(nbits) call, so a row
+    #   takes at most k calls to the generator instead of nbits
+    if nbits <= 0 or fill_prob <= 0.0:
+        return 0
+    mask = (1 << nbits) - 1
+    if fill_prob >= 1.0:
+        return mask
+    b = int(fill_prob * (1 << precision))
+    if b == 0:
+        return 0
+    acc = 0
+    # digits of fill_prob below its lowest set digit leave acc at 0
+    low = (b & -b).bit_length() - 1
+    for i in xrange(low, precision):
+        r = rng.getrandbits(nbits)
+        if (b >> i) & 1:
+            acc |= ~r
+        else:
+            acc &= ~r
+    return acc & mask
+
+
+def bits_to_row(bits, nbits):
+    # unpack the low nbits bits of an integer into a list of 0s and 1s
+    from string import maketrans
+    digits = bin(bits)[2:].zfill(nbits)[::-1][:nbits]
+    return list(bytearray(digits.translate(maketrans('01', '\x00\x01'))))
+
+
+class CAEngine:
+    # array-backed engine for the automaton. R[n] is counted for whole rows
+    # at once: every row gets a running (prefix) sum of its walls, which
+    # gives the horizontal part of the block in one subtraction, and the
+    # vertical part is a window sum that slides down the rows. a pass is
+    # O(N) whatever the radii of the rule, and the two grids are swapped
+    # after each pass instead of being copied tile by tile.
+    #
+    # a row can only change if a row within reach of the rule changed in
+    # the pass before, so when the same rule is run again only those rows
+    # are updated and the others are carried over as they are.
+    #
+    # tiles on the border of the map are never updated, and tiles outside
+    # of the map count as floors
+
+    def __init__(self, front, back, xsize, ysize):
+        self.front = front  # grid read by the next pass
+        self.back = back    # grid written by the next pass
+        self._xsize = xsize
+        self._ysize = ysize
+        self._last_cutoffs = None   # rule of the last pass
+        self._changed_rows = None   # rows changed by the last pass
+
+    def _rows_to_update(self, cutoffs, reach):
+        # rows that the next pass of the rule may change
+        ysize = self._ysize
+        if cutoffs != self._last_cutoffs or self._changed_rows is None:
+            return range(1, ysize - 1)
+        marks = [False] * ysize
+        for y in self._changed_rows:
+            for dirty in xrange(max(1, y - reach), min(ysize - 1, y + reach + 1)):
+                marks[dirty] = True
+        return [y for y in xrange(1, ysize - 1) if marks[y]]
+
+    def _carry_over(self, cutoffs, todo):
+        # make the back grid agree with the front grid outside the rows the
+        # next pass updates. the back grid holds the grid from before the
+        # last pass, so the two can only differ on rows the last pass
+        # changed, and (with the same rule) those are all to be updated
+        # anyway. a fresh engine or a new rule copies every row
+        src, dst = self.front, self.back
+        if cutoffs != self._last_cutoffs or self._changed_rows is None:
+            rows = xrange(self._ysize)
+        else:
+            todo = set(todo)
+            rows = [y for y in self._changed_rows if y not in todo]
+        for y in rows:
+            dst.set_row(y, src.get_row(y))
+
+    def _runs(self, rows):
+        # split a sorted list of rows into runs of consecutive rows
+        runs, start = [], 0
+        for i in xrange(1, len(rows) + 1):
+            if i == len(rows) or rows[i] != rows[i-1] + 1:
+                runs.append(rows[start:i])
+                start = i
+        return runs
+
+    def step(self, cutoffs):
+        # run one pass of a rule given as a list of (n, op, cutoff) and
+        # return the number of tiles changed
+        from operator import add, sub, or_, ne
+        xsize, ysize = self._xsize, self._ysize
+        src, dst = self.front, self.back
+        wall, floor = CavesMap.TILE_WALL, CavesMap.TILE_FLOOR
+
+        radii = sorted(set([term[0] for term in cutoffs]))
+        pad = radii[-1] if radii else 0
+        todo = self._rows_to_update(cutoffs, pad)
+        zeros = [0] * xsize
+
+        # walls[y]: 0/1 wall flags of row y, padded with pad floors on
+        # both sides; sums[y][i]: number of walls among walls[y][:i]
+        walls, sums = {}, {}
+
+        def __sums(y):
+            if y not in sums:
+                w = [0] * pad + [0 if v == floor else 1 for v in src.get_row(y)] + [0] * pad
+                s = [0] * (len(w) + 1)
+                acc = 0
+                for i, v in enumerate(w):
+                    acc += v
+                    s[i+1] = acc
+                walls[y], sums[y] = w, s
+            return sums[y]
+
+        counts = {}
+        for n in radii:
+            lo, hi = pad - n, pad + n + 1
+            hsums = {}
+
+            def __hsum(y):
+                # walls among (x-n, y) .. (x+n, y)
+                if y < 0 or y >= ysize:
+                    return zeros
+                if y not in hsums:
+                    s = __sums(y)
+                    hsums[y] = map(sub, s[hi:hi+xsize], s[lo:lo+xsize])
+                return hsums[y]
+
+            # slide a window of 2n+1 rows down every run of rows to update
+            counts[n] = blocks = {}
+            for run in self._runs(todo):
+                block = zeros
+                for y in xrange(run[0] - n - 1, run[0] + n):
+                    block = map(add, block, __hsum(y))
+                for y in run:
+                    block = map(add, block, __hsum(y + n))
+                    block = map(sub, block, __hsum(y - n - 1))
+                    blocks[y] = block
+            if n >= 2:
+                # take the corners of the block away
+                for y in todo:
+                    r = blocks[y]
+                    for cy in (y - n, y + n):
+                        if cy < 0 or cy >= ysize:
+                            continue
+                        __sums(cy)
+                        w = walls[cy]
+                        r = map(sub, r, w[lo:lo+xsize])
+                        r = map(sub, r, w[hi-1:hi-1+xsize])
+                    blocks[y] = r
+
+        self._carry_over(cutoffs, todo)
+        changed, changed_rows = 0, []
+        for y in todo:
+            src_row = src.get_row(y)
+            hit = [False] * xsize
+            for n, op, cutoff in cutoffs:
+                if op == GenerationRule.AT_LEAST:
+                    test = [c >= cutoff for c in counts[n][y]]
+                else:
+                    test = [c <= cutoff for c in counts[n][y]]
+                hit = map(or_, hit, test)
+            row = [wall if h else floor for h in hit]
+            row[0], row[-1] = src_row[0], src_row[-1]
+            diff = sum(map(ne, row, src_row))
+            if diff:
+                changed += diff
+                changed_rows.append(y)
+            dst.set_row(y, row)
+
+        self.front, self.back = dst, src
+        self._last_cutoffs = cutoffs
+        self._changed_rows = changed_rows
+        return changed
 
 
 class CavesMap:
     TILE_WALL  = 1
     TILE_FLOOR = 0
 
-    def __init__(self, xsize, ysize, fill_prob, gen_rules):
+    _RENDERER = TileRenderer({TILE_WALL: '#', TILE_FLOOR: '.'})
+
+    def __init__(self, xsize, ysize, fill_prob, gen_rules, compact=False,
+                 rng=None):
+        # compact: keep the grids in BitGrids (one bit per tile) instead of
+        #          TileGrids (one byte per tile)
+        # rng: random.Random the initial grid is drawn from, the random
+        #      module itself by default
+        import random
         self._xsize = xsize
         self._ysize = ysize
         self._fill_prob = fill_prob
         self._gen_rules = gen_rules
-        self._grid1 = CavesMap._rand_grid(xsize, ysize, fill_prob)
-        self._grid2 = CavesMap._rand_grid(xsize, ysize, 1.0)
+        self._compact = compact
+        self._passes = []
+        if rng is None:
+            rng = random
+        if compact:
+            self._grid1 = CavesMap._rand_bit_grid(xsize, ysize, fill_prob, rng)
+            self._grid2 = BitGrid(xsize, ysize, CavesMap.TILE_WALL)
+        else:
+            self._grid1 = CavesMap._rand_grid(xsize, ysize, fill_prob, rng)
+            self._grid2 = TileGrid(xsize, ysize, CavesMap.TILE_WALL)
         for rule in gen_rules:
             self._update(rule)
 
     @staticmethod
-    def _rand_grid(xsize, ysize, fill_prob):
-        from random import random
-        grid = [[0] * xsize for y in xrange(ysize)]
+    def _rand_grid(xsize, ysize, fill_prob, rng):
+        bit_grid = CavesMap._rand_bit_grid(xsize, ysize, fill_prob, rng)
+        grid = TileGrid(xsize, ysize)
         for y in xrange(ysize):
-            for x in xrange(xsize):
-                if random() < fill_prob:
-                    grid[y][x] = CavesMap.TILE_WALL
+            grid.set_row(y, bits_to_row(bit_grid.get_row(y), xsize))
+        return grid
+
+    @staticmethod
+    def _rand_bit_grid(xsize, ysize, fill_prob, rng):
+        # walls are drawn a row at a time with rand_bits; the border of the
+        # map is all walls
+        grid = BitGrid(xsize, ysize)
+        border = 1 | (1 << (xsize - 1))
         for y in xrange(ysize):
-            grid[y][0] = grid[y][xsize-1] = CavesMap.TILE_WALL
-        for x in xrange(xsize):
-            grid[0][x] = grid[ysize-1][x] = CavesMap.TILE_WALL
+            grid.set_row(y, rand_bits(rng, xsize, fill_prob) | border)
+        grid.set_row(0, -1)
+        grid.set_row(ysize - 1, -1)
         return grid
 
     def _update(self, rule):
-        for i in xrange(rule.reps):
-            self._update_aux(rule.r1_cutoff, rule.r2_cutoff)
-
-    def _update_aux(self, r1_cutoff, r2_cutoff):
-        for y in xrange(1, self._ysize-1):
-            for x in xrange(1,  self._xsize-1):
-                r1, r2 = 0, 0
-                for y_off in xrange(-1, 2):
-                    for x_off in xrange(-1, 2):
-                        if self._grid1[y+y_off][x+x_off] != CavesMap.TILE_FLOOR:
-                            r1 += 1
-                for y_oth in xrange(y - 2, y + 3):
-                    for x_oth in xrange(x - 2, x + 3):
-                        if abs(y - y_oth) == 2 and abs(x - x_oth) == 2:
-                            continue
-                        if y_oth < 0 or y_oth >= self._ysize or \
-                            x_oth < 0 or x_oth >= self._xsize:
-                            continue
-                        if self._grid1[y_oth][x_oth] != CavesMap.TILE_FLOOR:
-                            r2 += 1
-                if r1 >= r1_cutoff or r2 <= r2_cutoff:
-                    self._grid2[y][x] = CavesMap.TILE_WALL
-                else:
-                    self._grid2[y][x] = CavesMap.TILE_FLOOR
-        for y in xrange(1, self._ysize-1):
-            for x in xrange(1,  self._xsize-1):
-                self._grid1[y][x] = self._grid2[y][x]
+        # passes stop early once the grid stops changing
+        engine_class = BitCAEngine if self._compact else CAEngine
+        engine = engine_class(self._grid1, self._grid2, self._xsize, self._ysize)
+        cutoffs = rule.cutoffs()
+        passes = 0
+        while passes < rule.reps:
+            passes += 1
+            if not engine.step(cutoffs):
+                break
+        self._grid1, self._grid2 = engine.front, engine.back
+        self._passes.append(passes)
+
+    def get_passes(self):
+        # number of passes actually run for each rule
+        return self._passes[:]
 
     def get(self, x, y):
-        return self._grid1[y][x]
+        return self._grid1.get(x, y)
 
     def set(self, x, y, v):
-        self._grid1[y][x] = v
+        self._grid1.set(x, y, v)
 
     def get_xsize(self):
         return self._xsize
@@ -89,22 +312,322 @@ class CavesMap:
 
     def print_rules(self):
         output = 'W[0](p) = rand() < %f\n' % self._fill_prob
-        for rule in self._gen_rules:
-            output += 'Repeat %d : W\'(p) = R[1](p) >= %d || R[2](p) <= %d\n' \
-                      % (rule.reps, rule.r1_cutoff, rule.r2_cutoff)
+        for i, rule in enumerate(self._gen_rules):
+            output += 'Repeat %d : W\'(p) = %s\n' % (rule.reps, str(rule))
+            if self._passes[i] < rule.reps:
+                output += '  (stopped after %d passes)\n' % self._passes[i]
         print output
 
+    def _lines(self):
+        # the map as text, a row at a time
+        if not self._compact:
+            for line in CavesMap._RENDERER.rows(self._grid1):
+                yield line
+            return
+        for y in xrange(self._ysize):
+            bits = bin(self._grid1.get_row(y))[2:].zfill(self._xsize)
+            yield bits[::-1].replace('1', '#').replace('0', '.')
+
+    def write_to(self, fileobj):
+        for line in self._lines():
+            fileobj.write(line + '\n')
+
     def __str__(self):
-        ret = ''
-        for y in xrange(0, self._ysize):
-            line = ''
-            for x in xrange(0, self._xsize):
-                if self._grid1[y][x] == CavesMap.TILE_WALL:
-                    line += '#'
+        return ''.join([line + '\n' for line in self._lines()])
+
+    def save(self, path, seed=None):
+        # write the map to a binary map file (see map_file.py); a compact
+        # map is unpacked to a byte per tile on the way
+        from map_file import write_map
+        grid = self._grid1
+        if self._compact:
+            grid = TileGrid(self._xsize, self._ysize)
+            for y in xrange(self._ysize):
+                grid.set_row(y, bits_to_row(self._grid1.get_row(y), self._xsize))
+        params = {'fill_prob': self._fill_prob,
+                  'rules': [str(rule) for rule in self._gen_rules]}
+        write_map(path, grid, (), 'ca_caves', seed, params)
+
+
+#__________________________________________________________________________
+# Bit-packed grids
+#
+#   a BitGrid stores the wall/floor state one bit per tile: row y is an
+#   integer whose bit x is set when (x, y) is a wall. BitCAEngine runs the
+#   automaton over whole rows at once with bit-sliced arithmetic: a count
+#   is kept as a list of bit planes (least significant first), so every
+#   integer operation below works on all tiles of a row in parallel.
+#
+
+def _bs_add(a, b):
+    # add two bit-sliced numbers
+    if len(a) < len(b):
+        a, b = b, a
+    ret, carry = [], 0
+    for i in xrange(len(a)):
+        x = a[i]
+        y = b[i] if i < len(b) else 0
+        ret.append(x ^ y ^ carry)
+        carry = (x & y) | (carry & (x ^ y))
+    if carry:
+        ret.append(carry)
+    return ret
+
+
+def _bs_sub(a, b):
+    # subtract two bit-sliced numbers, a must not be less than b anywhere
+    ret, borrow = [], 0
+    for i in xrange(len(a)):
+        x = a[i]
+        y = b[i] if i < len(b) else 0
+        ret.append(x ^ y ^ borrow)
+        borrow = (~x & y) | (~(x ^ y) & borrow)
+    while ret and not ret[-1]:
+        ret.pop()
+    return ret
+
+
+def _bs_at_least(planes, cutoff, mask):
+    # tiles (within mask) whose count is no less than cutoff
+    if cutoff <= 0:
+        return mask
+    gt, eq = 0, mask
+    for i in reversed(xrange(max(len(planes), cutoff.bit_length()))):
+        p = planes[i] if i < len(planes) else 0
+        if (cutoff >> i) & 1:
+            eq &= p
+        else:
+            gt |= eq & p
+            eq &= ~p
+    return gt | eq
+
+
+class BitGrid:
+    def __init__(self, xsize, ysize, fill=CavesMap.TILE_FLOOR):
+        self._xsize = xsize
+        self._ysize = ysize
+        self._mask = (1 << xsize) - 1
+        bits = self._mask if fill != CavesMap.TILE_FLOOR else 0
+        self._rows = [bits] * ysize
+
+    def get(self, x, y):
+        return (self._rows[y] >> x) & 1
+
+    def set(self, x, y, v):
+        if v != CavesMap.TILE_FLOOR:
+            self._rows[y] |= 1 << x
+        else:
+            self._rows[y] &= ~(1 << x)
+
+    def get_xsize(self):
+        return self._xsize
+
+    def get_ysize(self):
+        return self._ysize
+
+    def get_row(self, y):
+        return self._rows[y]
+
+    def set_row(self, y, bits):
+        self._rows[y] = bits & self._mask
+
+
+class BitCAEngine(CAEngine):
+    # the same automaton as CAEngine, run over BitGrids. a block sum is
+    # built from shifted copies of the rows (horizontal part) and a window
+    # of rows sliding down the map (vertical part)
+
+    def step(self, cutoffs):
+        # run one pass of a rule given as a list of (n, op, cutoff) and
+        # return the number of tiles changed
+        xsize, ysize = self._xsize, self._ysize
+        src, dst = self.front, self.back
+        mask = (1 << xsize) - 1
+        border = (1 | (1 << (xsize - 1))) & mask
+        rows = [src.get_row(y) for y in xrange(ysize)]
+
+        radii = sorted(set([term[0] for term in cutoffs]))
+        todo = self._rows_to_update(cutoffs, radii[-1] if radii else 0)
+
+        def __shift(bits, d):
+            # bit x of the result is bit x+d of bits
+            return bits >> d if d >= 0 else (bits << -d) & mask
+
+        counts = {}
+        for n in radii:
+            hsums = {}
+
+            def __hsum(y):
+                # walls among (x-n, y) .. (x+n, y), bit-sliced
+                if y < 0 or y >= ysize:
+                    return []
+                if y not in hsums:
+                    planes = []
+                    for d in xrange(-n, n + 1):
+                        planes = _bs_add(planes, [__shift(rows[y], d)])
+                    hsums[y] = planes
+                return hsums[y]
+
+            counts[n] = blocks = {}
+            for run in self._runs(todo):
+                block = []
+                for y in xrange(run[0] - n - 1, run[0] + n):
+                    block = _bs_add(block, __hsum(y))
+                for y in run:
+                    block = _bs_add(block, __hsum(y + n))
+                    block = _bs_sub(block, __hsum(y - n - 1))
+                    blocks[y] = block
+                    if n >= 2:
+                        # take the corners of the block away
+                        for cy in (y - n, y + n):
+                            if cy < 0 or cy >= ysize:
+                                continue
+                            blocks[y] = _bs_sub(blocks[y], [__shift(rows[cy], n)])
+                            blocks[y] = _bs_sub(blocks[y], [__shift(rows[cy], -n)])
+
+        self._carry_over(cutoffs, todo)
+        changed, changed_rows = 0, []
+        for y in todo:
+            hit = 0
+            for n, op, cutoff in cutoffs:
+                if op == GenerationRule.AT_LEAST:
+                    hit |= _bs_at_least(counts[n][y], cutoff, mask)
                 else:
-                    line += '.'
-            ret += line + '\n'
-        return ret
+                    hit |= mask & ~_bs_at_least(counts[n][y], cutoff + 1, mask)
+            row = (hit & ~border) | (rows[y] & border)
+            diff = bin(row ^ rows[y]).count('1')
+            if diff:
+                changed += diff
+                changed_rows.append(y)
+            dst.set_row(y, row)
+
+        self.front, self.back = dst, src
+        self._last_cutoffs = cutoffs
+        self._changed_rows = changed_rows
+        return changed
+
+
+#__________________________________________________________________________
+# Unbounded cave worlds
+#
+#   a CaveWorld is an endless cave cut into square chunks, each generated
+#   on demand from the world seed and its chunk coordinates. the initial
+#   noise of a tile only depends on the world seed and the position of the
+#   tile, so the automaton can be run over a chunk grown by a halo of its
+#   neighbours' noise: one pass of a rule moves information at most R
+#   tiles (R being the largest radius of the rule), so with a halo as wide
+#   as the sum of reps * R over all rules, every tile of the chunk comes
+#   out as if the automaton had been run over the whole plane and chunk
+#   edges join seamlessly. there is no forced wall around chunks, and
+#   regions are not connected up across chunks.
+#
+#   finished chunks (and the noise they are made from) are held in LRU
+#   caches, so only chunks around the places being looked at stay in
+#   memory.
+#
+
+class _LRUCache:
+    def __init__(self, capacity):
+        from collections import OrderedDict
+        self._capacity = capacity
+        self._items = OrderedDict()
+
+    def get(self, key):
+        # returns None on a miss
+        value = self._items.pop(key, None)
+        if value is not None:
+            self._items[key] = value
+        return value
+
+    def put(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        while len(self._items) > self._capacity:
+            self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class CaveWorld:
+    TILE_WALL  = CavesMap.TILE_WALL
+    TILE_FLOOR = CavesMap.TILE_FLOOR
+
+    def __init__(self, seed, chunk_size, fill_prob, gen_rules, cache_size=64):
+        self._seed = seed
+        self._chunk_size = chunk_size
+        self._fill_prob = fill_prob
+        self._gen_rules = gen_rules
+        self._halo = 0
+        for rule in gen_rules:
+            radii = [term[0] for term in rule.cutoffs()]
+            self._halo += rule.reps * max([0] + radii)
+        self._chunks = _LRUCache(cache_size)
+        self._noise = _LRUCache(4 * cache_size)
+
+    def get_chunk_size(self):
+        return self._chunk_size
+
+    def get_chunk(self, cx, cy):
+        # tiles of chunk (cx, cy) as a chunk_size x chunk_size TileGrid;
+        # the chunk covers the world tiles from (cx, cy) * chunk_size
+        chunk = self._chunks.get((cx, cy))
+        if chunk is None:
+            chunk = self._make_chunk(cx, cy)
+            self._chunks.put((cx, cy), chunk)
+        return chunk
+
+    def get(self, x, y):
+        size = self._chunk_size
+        return self.get_chunk(x // size, y // size).get(x % size, y % size)
+
+    def _chunk_noise(self, cx, cy):
+        noise = self._noise.get((cx, cy))
+        if noise is None:
+            import random, hashlib
+            # seed from a digest of the world seed and the chunk position.
+            # packing them into one integer is not enough: Random() drops
+            # the sign of its seed, and it folds a long seed in 32-bit words
+            # in a way that lets different integers give the same numbers
+            key = '%d,%d,%d' % (self._seed, cx, cy)
+            mix = long(hashlib.sha1(key).hexdigest(), 16)
+            rng = random.Random(mix)
+            size = self._chunk_size
+            noise = TileGrid(size, size)
+            for y in xrange(size):
+                noise.set_row(y, bits_to_row(rand_bits(rng, size, self._fill_prob), size))
+            self._noise.put((cx, cy), noise)
+        return noise
+
+    def _make_chunk(self, cx, cy):
+        size, halo = self._chunk_size, self._halo
+        x0, y0 = cx * size - halo, cy * size - halo
+        span = size + 2 * halo
+
+        # noise of the chunk and its halo, pieced together from the noise
+        # of all chunks the halo reaches into
+        rows = [[] for y in xrange(span)]
+        for ncy in xrange(y0 // size, (y0 + span - 1) // size + 1):
+            ylo, yhi = max(y0, ncy * size), min(y0 + span, (ncy + 1) * size)
+            for ncx in xrange(x0 // size, (x0 + span - 1) // size + 1):
+                xlo, xhi = max(x0, ncx * size), min(x0 + span, (ncx + 1) * size)
+                noise = self._chunk_noise(ncx, ncy)
+                for y in xrange(ylo, yhi):
+                    rows[y-y0] += noise.get_row(y-ncy*size, xlo-ncx*size, xhi-ncx*size)
+        grid = TileGrid(span, span)
+        for y, row in enumerate(rows):
+            grid.set_row(y, row)
+
+        engine = CAEngine(grid, grid.copy(), span, span)
+        for rule in self._gen_rules:
+            cutoffs = rule.cutoffs()
+            for i in xrange(rule.reps):
+                if not engine.step(cutoffs):
+                    break
+        chunk = TileGrid(size, size)
+        for y in xrange(size):
+            chunk.set_row(y, engine.front.get_row(y + halo, halo, halo + size))
+        return chunk
 
 
 class point:
@@ -116,38 +639,121 @@ class point:
         return self.x == other.x and self.y == other.y
 
 
-def connect_up_regions(cmap):
-    xsize, ysize = cmap.get_xsize(), cmap.get_ysize()
-    region_map = [[0] * xsize for i in xrange(ysize)]
-    region_cnt = 1
-    for y in xrange(ysize):
-        for x in xrange(xsize):
-            if mark_region(cmap, x, y, region_map, region_cnt):
-                region_cnt += 1
+# ways of connecting up regions:
+#   CONNECT_RANDOM: join every region to the largest one with a random walk
+#   CONNECT_MST: join regions along a minimum spanning tree of the region
+#                adjacency graph with shortest tunnels
+CONNECT_RANDOM = 'random'
+CONNECT_MST    = 'mst'
 
-    print 'Number of Regions: %d' % (region_cnt - 1)
-    regions = [[] for i in xrange(region_cnt)]
 
-    print 'Region Map:'
-    output = ''
-    for y in xrange(ysize):
-        line = ''
-        for x in xrange(xsize):
-            region_id = region_map[y][x]
-            if region_id:
-                regions[region_id].append(point(x, y))
-            line += '%d' % region_id
-        line += '\n'
-        output += line
-    print output
-
-    max_region_id = get_max_region(regions)
-    print 'Max Region : %d' % max_region_id
-    for region_id in xrange(1, len(regions)):
+class ConnectResult:
+    # what connect_up_regions has done to a map
+    def __init__(self):
+        self.region_count = 0    # number of regions before connecting
+        self.region_sizes = [0]  # region_sizes[i]: number of tiles in region i
+        self.connections = []    # pairs of region ids that were connected
+        self.tunnels = []        # points turned from walls into floors
+        self.elapsed = 0.0       # seconds spent
+
+
+def connect_up_regions(cmap, mode=CONNECT_RANDOM, verbose=False):
+    # connect up disjoint regions of a map and return a ConnectResult.
+    # nothing is printed unless verbose is set, in which case the region
+    # map and every connection are dumped to stdout for debugging
+    import time
+    start = time.time()
+    result = ConnectResult()
+
+    region_map, sizes = label_regions(cmap)
+    region_cnt = len(sizes)
+    result.region_count = region_cnt - 1
+    result.region_sizes = sizes
+
+    if verbose:
+        print 'Number of Regions: %d' % (region_cnt - 1)
+
+        print 'Region Map:'
+        output = ''
+        for y in xrange(cmap.get_ysize()):
+            output += ''.join(['%d' % region_id for region_id in region_map[y]])
+            output += '\n'
+        print output
+
+    if mode == CONNECT_MST:
+        for region1_id, region2_id, tunnel in connect_regions_mst(cmap, region_map):
+            if verbose:
+                print 'connecting %d and %d ...' % (region1_id, region2_id)
+            result.connections.append((region1_id, region2_id))
+            result.tunnels += tunnel
+        result.elapsed = time.time() - start
+        return result
+
+    regions = RegionTiles(region_map, sizes)
+    max_region_id = get_max_region(sizes)
+    if verbose:
+        print 'Max Region : %d' % max_region_id
+    for region_id in xrange(1, region_cnt):
         if region_id == max_region_id:
             continue
-        print 'connecting %d and %d ...' % (region_id, max_region_id)
-        do_connect_regions(cmap, region_map, regions, region_id, max_region_id)
+        if verbose:
+            print 'connecting %d and %d ...' % (region_id, max_region_id)
+        result.connections.append((region_id, max_region_id))
+        result.tunnels += do_connect_regions(cmap, region_map, regions,
+                                             region_id, max_region_id)
+    result.elapsed = time.time() - start
+    return result
+
+
+def label_regions(cmap):
+    # label 4-connected regions of floors with a scanline flood fill, which
+    # needs no recursion and visits every tile a constant number of times.
+    # returns (region_map, sizes): region_map[y][x] is the id of the region
+    # (x, y) belongs to, 0 for walls, and sizes[i] is the number of tiles
+    # in region i (sizes[0] is always 0). regions are numbered in the
+    # order a row-major scan meets them, the same as with mark_region
+    xsize, ysize = cmap.get_xsize(), cmap.get_ysize()
+    is_open = [[cmap.get(x, y) != cmap.TILE_WALL for x in xrange(xsize)]
+               for y in xrange(ysize)]
+    region_map = [[0] * xsize for i in xrange(ysize)]
+    sizes = [0]
+
+    for y0 in xrange(ysize):
+        for x0 in xrange(xsize):
+            if not is_open[y0][x0] or region_map[y0][x0]:
+                continue
+            region_id, size = len(sizes), 0
+            stack = [(x0, y0)]
+            while stack:
+                x, y = stack.pop()
+                row, ids = is_open[y], region_map[y]
+                if ids[x]:
+                    continue
+                # grow the seed into the widest span of unlabelled floors
+                l, r = x, x
+                while l > 0 and row[l-1] and not ids[l-1]:
+                    l -= 1
+                while r < xsize - 1 and row[r+1] and not ids[r+1]:
+                    r += 1
+                ids[l:r+1] = [region_id] * (r - l + 1)
+                size += r - l + 1
+                # push one seed for every run of unlabelled floors that
+                # touches the span from above or below
+                for ny in (y - 1, y + 1):
+                    if ny < 0 or ny >= ysize:
+                        continue
+                    nrow, nids = is_open[ny], region_map[ny]
+                    in_run = False
+                    for nx in xrange(l, r + 1):
+                        if nrow[nx] and not nids[nx]:
+                            if not in_run:
+                                stack.append((nx, ny))
+                                in_run = True
+                        else:
+                            in_run = False
+            sizes.append(size)
+
+    return region_map, sizes
 
 
 def mark_region(cmap, x, y, region_map, region_id):
@@ -155,28 +761,132 @@ def mark_region(cmap, x, y, region_map, region_id):
         return False
     if cmap.get(x, y) == cmap.TILE_WALL or region_map[y][x] != 0:
         return False
-    region_map[y][x] = region_id
-    mark_region(cmap, x - 1, y, region_map, region_id)
-    mark_region(cmap, x, y - 1, region_map, region_id)
-    mark_region(cmap, x + 1, y, region_map, region_id)
-    mark_region(cmap, x, y + 1, region_map, region_id)
+    stack = [(x, y)]
+    while stack:
+        x, y = stack.pop()
+        if x < 0 or x >= cmap.get_xsize() or y < 0 or y >= cmap.get_ysize():
+            continue
+        if cmap.get(x, y) == cmap.TILE_WALL or region_map[y][x] != 0:
+            continue
+        region_map[y][x] = region_id
+        stack += [(x, y + 1), (x + 1, y), (x, y - 1), (x - 1, y)]
     return True
 
 
-def get_max_region(regions):
+class RegionTiles:
+    # tiles of all regions in one flat array, grouped by region (a counting
+    # sort of region_map) and in row-major order within a region
+
+    def __init__(self, region_map, sizes):
+        from array import array
+        self._xsize = len(region_map[0]) if region_map else 0
+        self._sizes = sizes
+        self._starts = [0] * len(sizes)
+        for i in xrange(1, len(sizes)):
+            self._starts[i] = self._starts[i-1] + sizes[i-1]
+        self._tiles = array('l', [0]) * sum(sizes)
+        next_ = self._starts[:]
+        for y, ids in enumerate(region_map):
+            for x, region_id in enumerate(ids):
+                if region_id:
+                    self._tiles[next_[region_id]] = y * self._xsize + x
+                    next_[region_id] += 1
+
+    def size(self, region_id):
+        return self._sizes[region_id]
+
+    def tile(self, region_id, i):
+        # the i-th tile of a region as a point
+        pos = self._tiles[self._starts[region_id] + i]
+        return point(pos % self._xsize, pos / self._xsize)
+
+
+def get_max_region(sizes):
     ret, max_len = 0, 0
-    for i, area in enumerate(regions):
-        l = len(area)
+    for i, l in enumerate(sizes):
         if l > max_len:
             ret, max_len = i, l
     return ret
 
 
+def connect_regions_mst(cmap, region_map):
+    # a breadth-first search started from all floors at once spreads every
+    # region over the walls around it (a distance transform). where two
+    # regions meet, the two search paths back to them form the shortest
+    # tunnel between them; these tunnels are the edges of the region
+    # adjacency graph, and the ones along its minimum spanning tree
+    # (Kruskal's algorithm) are carved out. returns the carved connections
+    # as a list of (region1_id, region2_id, tunnel tiles)
+    from array import array
+    xsize, ysize = cmap.get_xsize(), cmap.get_ysize()
+    owner = array('i', [0]) * (xsize * ysize)
+    dist = array('i', [-1]) * (xsize * ysize)
+    parent = array('i', [-1]) * (xsize * ysize)
+    queue = array('i')
+    for y in xrange(ysize):
+        for x, region_id in enumerate(region_map[y]):
+            if region_id:
+                u = y * xsize + x
+                owner[u], dist[u] = region_id, 0
+                queue.append(u)
+
+    # best[(a, b)]: (number of walls to carve, u, v) of the shortest tunnel
+    # found between regions a < b, meeting at neighbouring tiles u and v
+    best = {}
+    head = 0
+    while head < len(queue):
+        u = queue[head]
+        head += 1
+        ux, uy = u % xsize, u / xsize
+        # tunnels stay inside of the border of the map
+        for v, ok in ((u - 1, ux > 1), (u + 1, ux < xsize - 2),
+                      (u - xsize, uy > 1), (u + xsize, uy < ysize - 2)):
+            if not ok:
+                continue
+            if dist[v] == -1:
+                owner[v], dist[v], parent[v] = owner[u], dist[u] + 1, u
+                queue.append(v)
+            elif owner[v] != owner[u]:
+                a, b = min(owner[u], owner[v]), max(owner[u], owner[v])
+                cost = dist[u] + dist[v]
+                if (a, b) not in best or cost < best[(a, b)][0]:
+                    best[(a, b)] = (cost, u, v)
+
+    # union-find over region ids for Kruskal's algorithm
+    L = range(max([0] + [b for a, b in best]) + 1)
+
+    def __find(x):
+        root = x
+        while L[root] != root:
+            root = L[root]
+        while L[x] != root:
+            L[x], x = root, L[x]
+        return root
+
+    ret = []
+    for (a, b), (cost, u, v) in sorted(best.items(), key=lambda e: (e[1][0], e[0])):
+        ra, rb = __find(a), __find(b)
+        if ra == rb:
+            continue
+        L[ra] = rb
+        tunnel = []
+        for w in (u, v):
+            while dist[w] > 0:
+                x, y = w % xsize, w / xsize
+                # tunnels carved before may cross this one
+                if cmap.get(x, y) == cmap.TILE_WALL:
+                    cmap.set(x, y, cmap.TILE_FLOOR)
+                    tunnel.append(point(x, y))
+                w = parent[w]
+        ret.append((a, b, tunnel))
+    return ret
+
+
 def do_connect_regions(cmap, region_map, regions, region1_id, region2_id):
+    # returns the points turned from walls into floors
     from random import randint
-    region1, region2 = regions[region1_id], regions[region2_id]
-    pos1 = region1[randint(0, len(region1) - 1)]
-    pos2 = region2[randint(0, len(region2) - 1)]
+    pos1 = regions.tile(region1_id, randint(0, regions.size(region1_id) - 1))
+    pos2 = regions.tile(region2_id, randint(0, regions.size(region2_id) - 1))
 
     def __closer(new_pos, old_pos, target):
         def __dist2(p1, p2):
@@ -187,6 +897,7 @@ def do_connect_regions(cmap, region_map, regions, region1_id, region2_id):
 
     xsize, ysize = cmap.get_xsize(), cmap.get_ysize()
     dx, dy = [1, 0, -1, 0], [0, -1, 0, 1]
+    tunnel = []
     while not pos1.equals(pos2):
         dir = randint(0, 3)
         x, y = pos1.x + dx[dir], pos1.y + dy[dir]
@@ -199,26 +910,129 @@ def do_connect_regions(cmap, region_map, regions, region1_id, region2_id):
             break
         if cmap.get(x, y) == cmap.TILE_WALL:
             cmap.set(x, y, cmap.TILE_FLOOR)
+            tunnel.append(pos)
         pos1 = pos
-    return
+    return tunnel
 
 
 def print_usage():
     appname = os.path.basename(sys.argv[0])
-    print "Usage: %s xsize ysize fill_prob (r1 r2 count)+\n" % appname
+    print "Usage: %s xsize ysize fill_prob (r1 r2 count (n>=cutoff|n<=cutoff)*)+" % appname
+    print "       %s --batch [-j workers] [-o outdir] [--mst] [--compact] [--binary] \\" % appname
+    print "           first_seed last_seed xsize ysize fill_prob (r1 r2 count ...)+\n"
+
+
+def parse_rules(args):
+    # parse a list of rules given as "r1 r2 count" triples, each optionally
+    # followed by further terms such as "3>=12" or "4<=5"
+    rules = []
+    i, argc = 0, len(args)
+    while i < argc:
+        r1_cutoff = int(args[i])
+        r2_cutoff = int(args[i+1])
+        reps = int(args[i+2])
+        i += 3
+        cutoffs = []
+        while i < argc:
+            for op in (GenerationRule.AT_LEAST, GenerationRule.AT_MOST):
+                if op in args[i]:
+                    radius, cutoff = args[i].split(op)
+                    cutoffs.append((int(radius), op, int(cutoff)))
+                    break
+            else:
+                break
+            i += 1
+        rules.append(GenerationRule(r1_cutoff, r2_cutoff, reps, cutoffs))
+    return rules
+
+
+def generate_cave(seed, xsize, ysize, fill_prob, rules, mode=CONNECT_RANDOM,
+                  compact=False):
+    # generate a connected cave; the same seed always gives the same cave
+    import random
+    random.seed(seed)
+    cmap = CavesMap(xsize, ysize, fill_prob, rules, compact)
+    connect_up_regions(cmap, mode)
+    return cmap
+
+
+def _batch_job(job):
+    # runs in a worker process of batch_main
+    seed, outdir, binary, args = job
+    cmap = generate_cave(seed, *args)
+    if binary:
+        cmap.save(os.path.join(outdir, 'cave_%d.rmap' % seed), seed)
+        return seed
+    fp = open(os.path.join(outdir, 'cave_%d.txt' % seed), 'w')
+    try:
+        cmap.write_to(fp)
+    finally:
+        fp.close()
+    return seed
+
+
+def batch_main(argv):
+    # generate one cave for each seed in [first_seed, last_seed] across a
+    # pool of processes and write each of them to its own file, as text or
+    # (with --binary) as a binary map file
+    import getopt, multiprocessing, time
+    try:
+        opts, args = getopt.getopt(argv, 'j:o:', ['mst', 'compact', 'binary'])
+        workers, outdir = multiprocessing.cpu_count(), '.'
+        mode, compact, binary = CONNECT_RANDOM, False, False
+        for opt, val in opts:
+            if opt == '-j':
+                workers = int(val)
+            elif opt == '-o':
+                outdir = val
+            elif opt == '--mst':
+                mode = CONNECT_MST
+            elif opt == '--compact':
+                compact = True
+            elif opt == '--binary':
+                binary = True
+        first_seed, last_seed = int(args[0]), int(args[1])
+        xsize, ysize = int(args[2]), int(args[3])
+        fill_prob = float(args[4])
+        rules = parse_rules(args[5:])
+        assert workers > 0 and first_seed <= last_seed
+    except:
+        print_usage()
+        return -1
+
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    jobs = [(seed, outdir, binary, (xsize, ysize, fill_prob, rules, mode, compact))
+            for seed in xrange(first_seed, last_seed + 1)]
+
+    start = time.time()
+    if workers == 1:
+        for job in jobs:
+            _batch_job(job)
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            chunksize = max(1, len(jobs) / (4 * workers))
+            for seed in pool.imap_unordered(_batch_job, jobs, chunksize):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - start
+
+    print 'Generated %d maps in %.2f s (%.1f maps/s, %d workers)' \
+          % (len(jobs), elapsed, len(jobs) / max(elapsed, 1e-9), workers)
+    return 0
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--batch':
+        return batch_main(sys.argv[2:])
+
     try:
         xsize, ysize = int(sys.argv[1]), int(sys.argv[2])
         fill_prob = float(sys.argv[3])
-        argc = len(sys.argv)
-        rules = []
-        for i in range(4, argc, 3):
-            r1_cutoff = int(sys.argv[i])
-            r2_cutoff = int(sys.argv[i+1])
-            reps = int(sys.argv[i+2])
-            rules.append(GenerationRule(r1_cutoff, r2_cutoff, reps))
+        rules = parse_rules(sys.argv[4:])
     except:
         print_usage()
         return -1
@@ -228,7 +1042,7 @@ def main():
     print cmap
 
     # connect up disjoint segments
-    connect_up_regions(cmap)
+    connect_up_regions(cmap, verbose=True)
     print cmap
 
     return 0
@@ -0,0 +1,164 @@
+#
+#  Binary map files
+#
+#  A map file holds a generated map as raw tile planes, so it can be loaded
+#  without parsing and shared between processes through a memory map:
+#
+#     header     '<4sHHIII'   magic 'RMAP', format version, number of
+#                             planes, xsize, ysize, length of the metadata
+#     metadata   JSON         {"generator": ..., "seed": ..., "params": {...}}
+#     directory  '<16s1s7xQQ' per plane: name, array typecode ('B', 'H' or
+#                             'I'), offset of the plane in the file, length
+#                             of the plane in bytes
+#     planes                  xsize * ysize tiles each, row after row, little
+#                             endian, every plane starting on an 8-byte
+#                             boundary
+#
+#  The first plane is always 'tiles' (the TILE_* values of the map); other
+#  planes carry extra per-tile data, e.g. room and maze ids under 'id'.
+#
+
+
+import json, mmap, struct, sys
+from array import array
+
+from tile_grid import TileGrid
+
+
+MAGIC = 'RMAP'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sHHIII')
+_ENTRY = struct.Struct('<16s1s7xQQ')
+_ALIGN = 8
+
+
+def _align(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def write_map(path, tiles, planes=(), generator='', seed=None, params=None):
+    # tiles: TileGrid of the map; planes: (name, TileGrid) pairs of the same
+    # size; params: anything json can encode
+    xsize, ysize = tiles.get_xsize(), tiles.get_ysize()
+    planes = [('tiles', tiles)] + list(planes)
+    for name, grid in planes:
+        assert 0 < len(name) <= 16
+        assert grid.get_xsize() == xsize and grid.get_ysize() == ysize
+
+    meta = json.dumps({'generator': generator, 'seed': seed,
+                       'params': params or {}}, sort_keys=True)
+    offset = _align(_HEADER.size + len(meta) + _ENTRY.size * len(planes))
+    entries = []
+    for name, grid in planes:
+        nbytes = xsize * ysize * array(grid.get_typecode()).itemsize
+        entries.append((name, grid.get_typecode(), offset, nbytes))
+        offset = _align(offset + nbytes)
+
+    fp = open(path, 'wb')
+    try:
+        fp.write(_HEADER.pack(MAGIC, VERSION, len(planes), xsize, ysize, len(meta)))
+        fp.write(meta)
+        for entry in entries:
+            fp.write(_ENTRY.pack(*entry))
+        for (name, grid), (_, typecode, offset, nbytes) in zip(planes, entries):
+            fp.write('\0' * (offset - fp.tell()))
+            if typecode == 'B' or sys.byteorder == 'little':
+                fp.write(grid.tobytes())
+            else:
+                data = array(typecode, grid.tobytes())
+                data.byteswap()
+                fp.write(data.tostring())
+    finally:
+        fp.close()
+
+
+class MapFile:
+    # a map file mapped into memory read-only. tiles are read straight out
+    # of the mapping, so opening a file costs the same whatever the size of
+    # the map, and processes that open the same file share its pages
+
+    def __init__(self, path):
+        fp = open(path, 'rb')
+        try:
+            self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fp.close()
+
+        magic, version, nplanes, xsize, ysize, meta_len = \
+            _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise Exception('Not a map file: %s' % path)
+        if version != VERSION:
+            raise Exception('Unsupported map file version: %d' % version)
+        self._xsize = xsize
+        self._ysize = ysize
+
+        pos = _HEADER.size
+        self._meta = json.loads(self._mm[pos:pos+meta_len])
+        pos += meta_len
+
+        # name -> (struct format of a tile, itemsize, typecode, offset)
+        self._planes = {}
+        self._names = []
+        for i in xrange(nplanes):
+            name, typecode, offset, nbytes = _ENTRY.unpack_from(self._mm, pos)
+            pos += _ENTRY.size
+            name = name.rstrip('\0')
+            itemsize = array(typecode).itemsize
+            assert nbytes == xsize * ysize * itemsize
+            self._planes[name] = ('<' + typecode, itemsize, typecode, offset)
+            self._names.append(name)
+
+    def get_xsize(self):
+        return self._xsize
+
+    def get_ysize(self):
+        return self._ysize
+
+    def get_generator(self):
+        return self._meta['generator']
+
+    def get_seed(self):
+        return self._meta['seed']
+
+    def get_params(self):
+        return self._meta['params']
+
+    def get_planes(self):
+        return self._names[:]
+
+    def get(self, x, y, plane='tiles'):
+        fmt, itemsize, typecode, offset = self._planes[plane]
+        return struct.unpack_from(fmt, self._mm,
+                                  offset + (y * self._xsize + x) * itemsize)[0]
+
+    def get_row(self, y, plane='tiles'):
+        # a copy of row y, as an array
+        fmt, itemsize, typecode, offset = self._planes[plane]
+        start = offset + y * self._xsize * itemsize
+        row = array(typecode, self._mm[start:start + self._xsize * itemsize])
+        if itemsize > 1 and sys.byteorder != 'little':
+            row.byteswap()
+        return row
+
+    def view(self, plane='tiles'):
+        # a read-only view of the raw (little endian) bytes of a plane that
+        # shares memory with the mapping
+        fmt, itemsize, typecode, offset = self._planes[plane]
+        size = self._xsize * self._ysize * itemsize
+        try:
+            return memoryview(self._mm)[offset:offset+size]
+        except TypeError:
+            return buffer(self._mm, offset, size)
+
+    def to_tile_grid(self, plane='tiles'):
+        # a copy of a plane that can be changed
+        fmt, itemsize, typecode, offset = self._planes[plane]
+        grid = TileGrid(self._xsize, self._ysize, 0, typecode)
+        for y in xrange(self._ysize):
+            grid.set_row(y, self.get_row(y, plane))
+        return grid
+
+    def close(self):
+        self._mm.close()
@@ -0,0 +1,157 @@
+#
+#  Compact tile storage shared by the map generators
+#
+#  A TileGrid keeps the tiles of a map in one contiguous array of unsigned
+#  integers, row after row, so a tile takes one byte ('B') or two ('H')
+#  instead of a list slot pointing at a Python int. Tiles are whatever
+#  small integers a generator uses: the TILE_* bit flags of the dungeons,
+#  the wall/floor values of the caves, or region and room ids ('H', or
+#  'I' for ids that do not fit in 16 bits).
+#
+
+
+from array import array
+
+
+class TileGrid:
+    TYPECODES = ('B', 'H', 'I')
+
+    def __init__(self, xsize, ysize, fill=0, typecode='B'):
+        assert typecode in TileGrid.TYPECODES
+        self._xsize = xsize
+        self._ysize = ysize
+        self._typecode = typecode
+        self._data = array(typecode, [fill]) * (xsize * ysize)
+
+    @staticmethod
+    def typecode_for(max_value):
+        # the smallest typecode that holds values 0 .. max_value
+        if max_value < 1 << 8:
+            return 'B'
+        if max_value < 1 << 16:
+            return 'H'
+        return 'I'
+
+    def get_xsize(self):
+        return self._xsize
+
+    def get_ysize(self):
+        return self._ysize
+
+    def get_typecode(self):
+        return self._typecode
+
+    def get(self, x, y):
+        return self._data[y * self._xsize + x]
+
+    def set(self, x, y, value):
+        self._data[y * self._xsize + x] = value
+
+    def get_row(self, y, x1=0, x2=None):
+        # a copy of tiles x1 .. x2-1 of row y, as an array
+        if x2 is None:
+            x2 = self._xsize
+        start = y * self._xsize
+        return self._data[start+x1:start+x2]
+
+    def set_row(self, y, values, x1=0):
+        # overwrite row y from tile x1 on with values (any sequence of ints)
+        if not isinstance(values, array) or values.typecode != self._typecode:
+            values = array(self._typecode, values)
+        start = y * self._xsize + x1
+        assert x1 >= 0 and x1 + len(values) <= self._xsize
+        self._data[start:start+len(values)] = values
+
+    def row_view(self, y):
+        # a read-only view of row y that shares memory with the grid
+        return _view(self._data, y * self._xsize, self._xsize)
+
+    def fill_rect(self, x, y, width, height, value):
+        # set every tile of the rectangle to value, one row slice at a time.
+        # the rectangle must lie inside the grid: a slice running past the
+        # end of a row would spill into the next one
+        if width <= 0 or height <= 0:
+            return
+        assert 0 <= x and x + width <= self._xsize
+        assert 0 <= y and y + height <= self._ysize
+        run = array(self._typecode, [value]) * width
+        xsize = self._xsize
+        for row in xrange(y, y + height):
+            start = row * xsize + x
+            self._data[start:start+width] = run
+
+    def count(self, value):
+        return self._data.count(value)
+
+    def copy(self):
+        grid = TileGrid(0, 0, typecode=self._typecode)
+        grid._xsize, grid._ysize = self._xsize, self._ysize
+        grid._data = self._data[:]
+        return grid
+
+    def tobytes(self):
+        # all tiles, row after row, as a string of raw bytes (native byte
+        # order for 'H' and 'I')
+        return self._data.tostring()
+
+    def export(self):
+        # all tiles, row after row, as a read-only view sharing memory with
+        # the grid (native byte order for 'H' and 'I')
+        return _view(self._data, 0, len(self._data))
+
+
+class TileRenderer:
+    # draws a TileGrid as text, one character per tile. glyphs maps every
+    # tile value that may appear on the grid to its character; a row of a
+    # byte grid is drawn with a single str.translate, and rows are joined
+    # (or written out) a line at a time
+
+    def __init__(self, glyphs):
+        from string import maketrans
+        self._glyphs = dict(glyphs)
+        for value, glyph in self._glyphs.items():
+            assert len(glyph) == 1
+        byte_values = sorted([v for v in self._glyphs if 0 <= v < 256])
+        self._defined = ''.join([chr(v) for v in byte_values])
+        self._table = maketrans(self._defined,
+                                ''.join([self._glyphs[v] for v in byte_values]))
+
+    def _undefined(self, row):
+        for value in row:
+            if value not in self._glyphs:
+                raise Exception('Undefined tile: %d' % value)
+
+    def render_row(self, grid, y):
+        row = grid.get_row(y)
+        if row.typecode == 'B':
+            raw = row.tostring()
+            if raw.translate(None, self._defined):
+                self._undefined(row)
+            return raw.translate(self._table)
+        try:
+            return ''.join([self._glyphs[value] for value in row])
+        except KeyError:
+            self._undefined(row)
+
+    def rows(self, grid):
+        for y in xrange(grid.get_ysize()):
+            yield self.render_row(grid, y)
+
+    def render(self, grid):
+        return ''.join([line + '\n' for line in self.rows(grid)])
+
+    def write_to(self, grid, fileobj):
+        # stream the grid out a line at a time, so the whole picture never
+        # has to be held as one string
+        for line in self.rows(grid):
+            fileobj.write(line + '\n')
+
+
+def _view(data, start, size):
+    # arrays only have the new buffer interface (memoryview) in Python 3;
+    # in Python 2 they have the old one, which buffer() wraps
+    try:
+        return memoryview(data)[start:start+size]
+    except TypeError:
+        itemsize = data.itemsize
+        return buffer(data, start * itemsize, size * itemsize)
@@ -14,15 +14,16 @@
 #  Written by William Cheung, 04/20/2016
 #
 
+import sys
+
+from tile_grid import TileGrid, TileRenderer
+
 #_________________________________________________________________________
 # Primitive predicates for floating point numbers
 
 def is_zero(x):
     return abs(x) < 1e-6
 
-def is_equal(x, y):
-    return is_zero(x - y)
-
 #_________________________________________________________________________
 # Utility methods for generating random point or numbers
 
@@ -71,7 +72,9 @@ def normal_distribution(mu, sigma):
 #_________________________________________________________________________
 # A "great" utility class for manipulating points and vectors ( Really ? )
 
-class Vector2:
+class Vector2(object):
+    __slots__ = ('x', 'y')
+
     def __init__(self, x, y):
         self.x = x
         self.y = y
@@ -79,6 +82,9 @@ class Vector2:
     def __eq__(self, other):
         return self.x == other.x and self.y == other.y
 
+    def __ne__(self, other):
+        return not self == other
+
     def len_squared(self):
      return self.x * self.x + self.y * self.y
 
@@ -140,48 +146,58 @@ class Vector2:
 # Basic algorithms in computational geometry used in our Delaunay
 #   Triangulation implementation
 
-# calculate area of a triangle
-def triangle_area(A, B, C):
-    prod = Vector2.cross_product(Vector2.sub(B, A), Vector2.sub(C, A))
-    return abs(prod) / 2.0
-
-# test if a point P is in the triangle region ABC
-def point_in_triangle(P, A, B, C):
-    s1 = triangle_area(P, A, B)
-    s2 = triangle_area(P, B, C)
-    s3 = triangle_area(P, C, A)
-    s = triangle_area(A, B, C)
-    return is_equal(s, s1 + s2 + s3)
-
-# test if a point P is on the line segment AB
-def point_on_linesegment(P, A, B):
-    d1 = Vector2.dist(P, A)
-    d2 = Vector2.dist(P, B)
-    d = Vector2.dist(A, B)
-    return is_equal(d, d1 + d2)
-
-# calculate /_ABC (in radian)
-def angle(A, B, C):
-    v1 = Vector2.sub(A, B)
-    v2 = Vector2.sub(C, B)
-    cos_theta = 1.0 * Vector2.dot_product(v1, v2) / v1.len_() / v2.len_()
-    from math import acos
-    return acos(cos_theta)
+# Exact predicates
+#   the two predicates below only multiply, add and subtract coordinates,
+#   so they give exact signs for integer coordinates (room centres are
+#   integers) and for Fractions. floats should go through exact() first:
+#   a float stands for a fraction exactly, but products of floats are
+#   rounded
+
+def exact(v):
+    # an exact (int or Fraction) equivalent of a coordinate
+    if isinstance(v, float):
+        from fractions import Fraction
+        return Fraction(v)
+    return v
+
+# > 0 if A, B, C turn counter-clockwise, < 0 if clockwise, 0 if collinear
+def orient2d(ax, ay, bx, by, cx, cy):
+    return (bx - ax) * (cy - ay) - (by - ay) * (cx - ax)
+
+# > 0 if D is inside the circumcircle of the counter-clockwise triangle
+# ABC, < 0 if outside, 0 if on it
+def in_circle(ax, ay, bx, by, cx, cy, dx, dy):
+    adx, ady = ax - dx, ay - dy
+    bdx, bdy = bx - dx, by - dy
+    cdx, cdy = cx - dx, cy - dy
+    ad = adx * adx + ady * ady
+    bd = bdx * bdx + bdy * bdy
+    cd = cdx * cdx + cdy * cdy
+    return adx * (bdy * cd - bd * cdy) \
+         - ady * (bdx * cd - bd * cdx) \
+         + ad * (bdx * cdy - bdy * cdx)
 
 #__________________________________________________________________________
 # Delaunay Triangulation
 #   see http://www.cnblogs.com/soroman/archive/2007/05/17/750430.html
 
-class Edge:
+class Edge(object):
+    __slots__ = ('u', 'v')
+
     def __init__(self, u, v):
         self.u = u
         self.v = v
 
-class Triangle:
+class Triangle(object):
+    # triangles are equal if they have the same vertices in any order; _key
+    # (the sorted vertices) is what they are compared and hashed by
+    __slots__ = ('A', 'B', 'C', '_key')
+
     def __init__(self, A, B, C):
         self.A = A
         self.B = B
         self.C = C
+        self._key = tuple(sorted((A, B, C)))
 
     def edges(self):
         return [Edge(self.A, self.B),
@@ -189,31 +205,36 @@ class Triangle:
                 Edge(self.C, self.A)]
 
     def __eq__(self, other):
-        s1 = {self.A, self.B, self.C}
-        s2 = {other.A, other.B, other.C}
-        return s1 == s2
+        return self._key == other._key
+
+    def __ne__(self, other):
+        return self._key != other._key
 
     def __hash__(self):
-        return hash(tuple([self.A, self.B, self.C]))
+        return hash(self._key)
 
 # Delaunay graph constructor
 class DelaunayGraph:
     def __init__(self, points):
-        self._points = points
+        self._points = [Vector2(exact(p.x), exact(p.y)) for p in points]
         self._npoints = len(points)
         self._triangles = []
+        self._twins = []    # (i, j): point i sits on point j and was skipped
         self._compute_triangles()
 
     def _compute_triangles(self):
 
-        # produce a big auxilliary triangle containing all points
+        # produce a big auxilliary triangle containing all points: every
+        # point is in the square [-M, M] x [-M, M], which lies strictly
+        # inside the triangle below
         M = 0
         for point in self._points:
-            m = max(point.x, point.y)
+            m = max(abs(point.x), abs(point.y))
             M = max(m, M)
-        self._points += [Vector2(3 * M, 0),
-                         Vector2(0, 3 * M),
-                         Vector2(-3 * M, -3 * M)]
+        M += 1
+        self._points += [Vector2(4 * M, 0),
+                         Vector2(0, 4 * M),
+                         Vector2(-4 * M, -4 * M)]
         n = self._npoints
         self._triangles.append(Triangle(n, n + 1, n + 2))
         # Note: we use indices of vertices instead of vectices themselves
@@ -248,6 +269,15 @@ class DelaunayGraph:
         # find triangles that contain _point[i]
         t = self._locate_triangle(i)
 
+        # if the point is on a vertex (of three or more triangles), it is
+        # already in the triangulation
+        if len(t) > 2:
+            P = self._points[i]
+            for j in (t[0].A, t[0].B, t[0].C):
+                if self._points[j] == P:
+                    self._twins.append((i, j))
+                    return
+
         # if the point is in only one triangle
         if len(t) == 1:
             self._triangles.remove(t[0])
@@ -285,11 +315,16 @@ class DelaunayGraph:
 
 
     def _locate_triangle(self, point_idx):
+        # triangles that contain the point, borders included
         P = self._points[point_idx]
         ret = []
         for t in self._triangles:
             A, B, C = self._triangle_points(t)
-            if point_in_triangle(P, A, B, C):
+            o1 = orient2d(A.x, A.y, B.x, B.y, P.x, P.y)
+            o2 = orient2d(B.x, B.y, C.x, C.y, P.x, P.y)
+            o3 = orient2d(C.x, C.y, A.x, A.y, P.x, P.y)
+            if (o1 >= 0 and o2 >= 0 and o3 >= 0) or \
+                    (o1 <= 0 and o2 <= 0 and o3 <= 0):
                 ret.append(t)
         return ret
 
@@ -319,13 +354,12 @@ class DelaunayGraph:
         if r is None:
             return False
 
-        def __p(i):
-            return self._points[i]
-
-        from math import pi
-        a1 = angle(__p(t.A), __p(q), __p(t.B))
-        a2 = angle(__p(t.A), __p(t.C), __p(t.B))
-        if a1 + a2 < pi:
+        # the edge <A, B> is flipped iff q is inside the circumcircle of t
+        # (/_AqB + /_ACB > pi)
+        A, B, C, Q = [self._points[j] for j in (t.A, t.B, t.C, q)]
+        if orient2d(A.x, A.y, B.x, B.y, C.x, C.y) < 0:
+            A, B = B, A
+        if in_circle(A.x, A.y, B.x, B.y, C.x, C.y, Q.x, Q.y) <= 0:
             return False
 
         self._triangles.remove(r)
@@ -355,6 +389,189 @@ class DelaunayGraph:
             ret[t.B].add(t.A)
             ret[t.C].add(t.A)
             ret[t.C].add(t.B)
+        for i, j in self._twins:
+            ret[i].add(j)
+            ret[j].add(i)
+        return ret
+
+#__________________________________________________________________________
+# Bowyer-Watson Delaunay Triangulation
+#
+#   points are inserted one at a time into a triangulation that starts as
+#   one big triangle around all of them. the triangle containing a new point
+#   is found by walking towards the point across triangle edges, the
+#   triangles whose circumcircles contain the point (the "cavity") are
+#   found by a search over triangle neighbours, and the cavity is replaced
+#   by a fan of triangles around the point. points are inserted in Z-order
+#   (Morton order), so each walk starts next to the point being inserted
+#   and the whole triangulation takes O(n log n) expected time.
+#
+#   triangle t is stored at _tv[3t:3t+3] as three vertex indices in
+#   counter-clockwise order, and _tn[3t+i] is the triangle across the edge
+#   opposite to vertex _tv[3t+i] (-1 if there is none). replaced triangles
+#   are marked dead with _tv[3t] = -1.
+
+def _morton_key(x, y):
+    # interleave the bits of two 16-bit integers
+    key = 0
+    for bit in xrange(16):
+        key |= ((x >> bit) & 1) << (2 * bit)
+        key |= ((y >> bit) & 1) << (2 * bit + 1)
+    return key
+
+
+class BowyerWatsonGraph:
+    def __init__(self, points):
+        self._npoints = len(points)
+        self._xs = [exact(p.x) for p in points]
+        self._ys = [exact(p.y) for p in points]
+        self._tv = []
+        self._tn = []
+        self._twins = []    # (i, j): point i sits on point j and was skipped
+        self._compute_triangles()
+
+    def _compute_triangles(self):
+        n = self._npoints
+        if n == 0:
+            return
+        xs, ys = self._xs, self._ys
+
+        # a triangle far bigger than the bounding box of the points. the
+        # further away its corners are, the less they bend the triangulation
+        # near the hull of the points
+        x0, x1, y0, y1 = min(xs), max(xs), min(ys), max(ys)
+        d = max(x1 - x0, y1 - y0, 1) * 1024
+        xs += [x0 - d, x1 + d, (x0 + x1) / 2]
+        ys += [y0 - d, y0 - d, y1 + d]
+        self._new_triangle(n, n + 1, n + 2, -1, -1, -1)
+
+        # insertion in Z-order
+        sx = 65535.0 / max(x1 - x0, 1)
+        sy = 65535.0 / max(y1 - y0, 1)
+        order = sorted(xrange(n), key=lambda i: (
+            _morton_key(int((xs[i] - x0) * sx), int((ys[i] - y0) * sy)), i))
+
+        last = 0
+        for i in order:
+            last = self._insert(i, last)
+
+    def _new_triangle(self, a, b, c, na, nb, nc):
+        t = len(self._tv) // 3
+        self._tv += [a, b, c]
+        self._tn += [na, nb, nc]
+        return t
+
+    def _locate(self, i, t):
+        # walk from triangle t to a triangle that contains point i: leave
+        # each triangle through an edge that has the point on its far side
+        xs, ys, tv, tn = self._xs, self._ys, self._tv, self._tn
+        px, py = xs[i], ys[i]
+        steps, limit = 0, len(tv) // 3
+        start = 0
+        while steps <= limit:
+            steps += 1
+            for k in xrange(3):
+                e = (start + k) % 3
+                a, b = tv[3*t + (e+1) % 3], tv[3*t + (e+2) % 3]
+                if orient2d(xs[a], ys[a], xs[b], ys[b], px, py) < 0:
+                    t = tn[3*t + e]
+                    start = (start + 1) % 3  # vary the exit we try first
+                    break
+            else:
+                return t
+        # the walk went around in circles (it cannot with exact predicates);
+        # fall back to looking at every triangle
+        for t in xrange(len(tv) // 3):
+            if tv[3*t] < 0:
+                continue
+            a, b, c = tv[3*t:3*t+3]
+            if orient2d(xs[a], ys[a], xs[b], ys[b], px, py) >= 0 and \
+                    orient2d(xs[b], ys[b], xs[c], ys[c], px, py) >= 0 and \
+                    orient2d(xs[c], ys[c], xs[a], ys[a], px, py) >= 0:
+                return t
+        raise Exception('point %d is outside the triangulation' % i)
+
+    def _insert(self, i, t):
+        # insert point i, starting the search at triangle t; returns one of
+        # the triangles made
+        xs, ys, tv, tn = self._xs, self._ys, self._tv, self._tn
+        px, py = xs[i], ys[i]
+
+        t = self._locate(i, t)
+        for v in tv[3*t:3*t+3]:
+            if xs[v] == px and ys[v] == py:
+                self._twins.append((i, v))
+                return t
+
+        # grow the cavity from the triangle containing the point
+        cavity = set([t])
+        stack = [t]
+        while stack:
+            u = stack.pop()
+            for k in xrange(3):
+                w = tn[3*u + k]
+                if w < 0 or w in cavity:
+                    continue
+                a, b, c = tv[3*w:3*w+3]
+                if in_circle(xs[a], ys[a], xs[b], ys[b], xs[c], ys[c], px, py) > 0:
+                    cavity.add(w)
+                    stack.append(w)
+
+        # boundary edges of the cavity, as (a, b, triangle outside)
+        boundary = []
+        for u in cavity:
+            for k in xrange(3):
+                w = tn[3*u + k]
+                if w in cavity:
+                    continue
+                boundary.append((tv[3*u + (k+1) % 3], tv[3*u + (k+2) % 3], w, u))
+            tv[3*u] = -1
+
+        # a fan of triangles (a, b, i) around the point
+        by_start, by_end = {}, {}
+        for a, b, w, u in boundary:
+            nt = self._new_triangle(a, b, i, -1, -1, w)
+            by_start[a], by_end[b] = nt, nt
+            if w >= 0:
+                for k in xrange(3):
+                    if tn[3*w + k] == u:
+                        tn[3*w + k] = nt
+        for a, b, w, u in boundary:
+            nt = by_start[a]
+            tn[3*nt] = by_start[b]      # across edge (b, i)
+            tn[3*nt + 1] = by_end[a]    # across edge (i, a)
+        return nt
+
+    def triangles(self):
+        # triangles among the points (none of their corners is a corner of
+        # the bounding triangle)
+        n, tv = self._npoints, self._tv
+        ret = []
+        for t in xrange(len(tv) // 3):
+            a, b, c = tv[3*t:3*t+3]
+            if 0 <= a < n and b < n and c < n:
+                ret.append(Triangle(a, b, c))
+        return ret
+
+    # construct adjacency list of the graph
+    def adjacency_list(self):
+        # edges between two of the points are taken from all triangles, so
+        # points that are all on one line are still linked up
+        n, tv = self._npoints, self._tv
+        ret = []
+        for i in xrange(n):
+            ret.append(set())
+        for t in xrange(len(tv) // 3):
+            if tv[3*t] < 0:
+                continue
+            a, b, c = tv[3*t:3*t+3]
+            for u, v in ((a, b), (b, c), (c, a)):
+                if u < n and v < n:
+                    ret[u].add(v)
+                    ret[v].add(u)
+        for i, j in self._twins:
+            ret[i].add(j)
+            ret[j].add(i)
         return ret
 
 #__________________________________________________________________________
@@ -373,21 +590,43 @@ class Settings:
     def __getitem__(self, item):
         return self._settings[item]
 
+    def get(self, item, default=None):
+        # for optional settings
+        return self._settings.get(item, default)
+
+    def as_dict(self):
+        return dict(self._settings)
+
 
 # Class for representation of cells and rooms in our dungeon generator
-class Rect:
+#   location() and center() hand out vectors that are kept until the rect
+#   moves or is resized, so callers must not change them
+class Rect(object):
+    __slots__ = ('x', 'y', 'w', 'h', 'v', '_cached_at', '_location', '_center')
+
     def __init__(self, x, y, width, height):
         self.x = x
         self.y = y
         self.w = width
         self.h = height
         self.v = Vector2(0, 0)
+        self._cached_at = None
+
+    def _update_cache(self):
+        at = self._cached_at
+        if at is None or at[0] != self.x or at[1] != self.y or \
+                at[2] != self.w or at[3] != self.h:
+            self._cached_at = (self.x, self.y, self.w, self.h)
+            self._location = Vector2(self.x, self.y)
+            self._center = Vector2(self.x + self.w / 2, self.y + self.h / 2)
 
     def location(self):
-        return Vector2(self.x, self.y)
+        self._update_cache()
+        return self._location
 
     def center(self):
-        return Vector2(self.x + self.w / 2, self.y + self.h / 2)
+        self._update_cache()
+        return self._center
 
     def overlaps(self, other):
         x1 = max(self.x, other.x)
@@ -396,6 +635,43 @@ class Rect:
         y2 = min(self.y + self.h, other.y + other.h)
         return x1 <= x2 and y1 <= y2
 
+# Broad phase for overlap tests between cells
+#   a uniform grid of square buckets: a cell is filed under every bucket
+#   its rectangle (borders included, as in Rect.overlaps) touches, so two
+#   overlapping cells always share a bucket. cells with a negative width
+#   or height never overlap anything and are not filed at all.
+class _CellGrid:
+    def __init__(self, bucket_size):
+        self._size = max(1, bucket_size)
+        self._buckets = {}
+
+    def _keys(self, rect):
+        if rect.w < 0 or rect.h < 0:
+            return []
+        s = self._size
+        return [(bx, by)
+                for by in xrange(rect.y // s, (rect.y + rect.h) // s + 1)
+                for bx in xrange(rect.x // s, (rect.x + rect.w) // s + 1)]
+
+    def insert(self, key, rect):
+        for bucket in self._keys(rect):
+            self._buckets.setdefault(bucket, set()).add(key)
+
+    def remove(self, key, rect):
+        for bucket in self._keys(rect):
+            keys = self._buckets[bucket]
+            keys.discard(key)
+            if not keys:
+                del self._buckets[bucket]
+
+    def query(self, rect):
+        # keys of cells that share a bucket with rect
+        ret = set()
+        for bucket in self._keys(rect):
+            ret.update(self._buckets.get(bucket, ()))
+        return ret
+
+
 # The generator class
 class Dungeon:
     TILE_ROOM = 0x01
@@ -403,7 +679,11 @@ class Dungeon:
     TILE_CORR = 0x04  # corridors
     TILE_CELL = 0x08
 
+    _RENDERER = TileRenderer({TILE_ROOM: 'x', TILE_CELL: '+', TILE_CORR: '#',
+                              TILE_ROCK: ' '})
+
     def __init__(self, settings):
+        self._settings = settings
         self._width  = settings['dungeon_width']    # width of the dungeon
         self._height = settings['dungeon_height']   # height of the dungeon
 
@@ -414,6 +694,9 @@ class Dungeon:
         # max. no. of attempts to relocate cells
         self._reloc_attempts  = settings['reloc_attempts']
 
+        # move all cells at once in each relocation step (optional)
+        self._batch_reloc = settings.get('batch_relocation', False)
+
         # min. size of rooms
         self._min_room_width  = settings['min_room_width']
         self._min_room_height = settings['min_room_height']
@@ -424,13 +707,13 @@ class Dungeon:
         self._cells = None
         self._rooms = None
 
-        # a dungeon is constructed as a two-dimensional matrix
+        # a dungeon is constructed as a two-dimensional matrix (a TileGrid)
         self._rep_mat = None
 
     def generate(self):
         print 'Cells Expected: %d' % self._ncells_exp
 
-        self._rep_mat = [[Dungeon.TILE_ROCK] * self._width for i in xrange(self._height)]
+        self._rep_mat = TileGrid(self._width, self._height, Dungeon.TILE_ROCK)
 
         # generate cells of random position, width and height within a circle
         self._make_cells()
@@ -495,7 +778,10 @@ class Dungeon:
             if not active_cells:
                 break
 
-            self._relocate_step(active_cells)
+            if self._batch_reloc:
+                self._relocate_step_batch(active_cells)
+            else:
+                self._relocate_step(active_cells)
 
             step += 1
             if step == max_step:
@@ -507,23 +793,28 @@ class Dungeon:
         # clear cells that are out of dungeon bounds
         self._clear_oob_cells()
 
+    def _cell_grid(self, cells):
+        # a broad phase holding cells[i] under key i
+        size = max([max(cell.w, cell.h) for cell in cells] or [1]) + 1
+        grid = _CellGrid(size)
+        for i, cell in enumerate(cells):
+            grid.insert(i, cell)
+        return grid
+
     def _get_active_cells(self):
+        cells = self._cells
+        grid = self._cell_grid(cells)
         active_cells = []
-        for cell in self._cells:
-            is_active = False
-            for other in self._cells:
-                if other is cell:
-                    continue
-                if other.overlaps(cell):
-                    is_active = True
+        for i, cell in enumerate(cells):
+            for j in grid.query(cell):
+                if j != i and cells[j].overlaps(cell):
+                    active_cells.append(cell)
                     break
-            if is_active:
-                active_cells.append(cell)
         return active_cells
 
     def _clear_active_cells(self, active_cells):
-        for cell in active_cells:
-            self._cells.remove(cell)
+        active = set([id(cell) for cell in active_cells])
+        self._cells = [cell for cell in self._cells if id(cell) not in active]
 
     def _clear_oob_cells(self):
         # oob: out of bounds
@@ -542,33 +833,106 @@ class Dungeon:
 
         coeff_1, coeff_2 = 1.0, 4.0
 
-        for cell in active_cells:
-            velocity = Vector2(0, 0)
+        # cells move one after another, and each sees the others where they
+        # are at its turn, so the broad phase follows every move. the cells
+        # a cell is pushed away from are taken in list order, as the sum of
+        # the pushes (and the random calls made for coincident centers)
+        # depends on it
+        grid = self._cell_grid(active_cells)
 
-            for other in active_cells:
-                if other is cell:
-                    continue
+        # the vector math is done on plain numbers, in the same order of
+        # operations as the Vector2 methods (sub, normalize, add_) would do it
+        from math import sqrt
+
+        for i, cell in enumerate(active_cells):
+            vx, vy = 0, 0
+            center = cell.center()
 
-                if not other.overlaps(cell):
+            for j in sorted(grid.query(cell)):
+                other = active_cells[j]
+                if j == i or not other.overlaps(cell):
                     continue
 
-                diff = Vector2.sub(cell.center(), other.center())
-                dist = diff.len_squared()
+                other_center = other.center()
+                dx, dy = center.x - other_center.x, center.y - other_center.y
+                dist = dx * dx + dy * dy
 
                 if is_zero(dist):
                     dist = 1.0
-                    diff = Vector2.rand_unit()
+                    unit = Vector2.rand_unit()
+                    dx, dy = unit.x, unit.y
 
                 scale = coeff_1 / dist
-                diff.normalize(scale)
+                factor = 1.0 * scale / sqrt(dx * dx + dy * dy)
+
+                vx += dx * factor
+                vy += dy * factor
+
+            length = sqrt(vx * vx + vy * vy)
+            if not is_zero(length):
+                factor = 1.0 * coeff_2 / length
+                vx *= factor
+                vy *= factor
+
+            grid.remove(i, cell)
+            cell.x += int(round(vx))
+            cell.y += int(round(vy))
+            grid.insert(i, cell)
+
+    def _relocate_step_batch(self, active_cells):
+        # same forces as _relocate_step, but every cell is pushed by the
+        # others where they were at the start of the step and all cells move
+        # together. positions and sizes are held in parallel lists, and
+        # overlapping pairs are found by sweeping the cells in order of
+        # their left edges: a cell can only overlap the cells that start
+        # before its right edge does
 
-                velocity.add_(diff)
+        from math import sqrt
+        from random import randint
 
-            if not velocity.is_zero():
-                velocity.normalize(coeff_2)
+        coeff_1, coeff_2 = 1.0, 4.0
+        ux, uy = [1, 0, -1, 0], [0, -1, 0, 1]
+
+        n = len(active_cells)
+        xs = [cell.x for cell in active_cells]
+        ys = [cell.y for cell in active_cells]
+        ws = [cell.w for cell in active_cells]
+        hs = [cell.h for cell in active_cells]
+        cxs = [xs[i] + ws[i] / 2 for i in xrange(n)]
+        cys = [ys[i] + hs[i] / 2 for i in xrange(n)]
+        vxs, vys = [0.0] * n, [0.0] * n
+
+        # cells with a negative size never overlap (see Rect.overlaps)
+        order = sorted([i for i in xrange(n) if ws[i] >= 0 and hs[i] >= 0],
+                       key=lambda i: (xs[i], i))
+        for k, i in enumerate(order):
+            right, top, bottom = xs[i] + ws[i], ys[i], ys[i] + hs[i]
+            for kk in xrange(k + 1, len(order)):
+                j = order[kk]
+                if xs[j] > right:
+                    break
+                if ys[j] > bottom or ys[j] + hs[j] < top:
+                    continue
 
-            cell.x += int(round(velocity.x))
-            cell.y += int(round(velocity.y))
+                # push i away from j and j away from i by coeff_1 / dist
+                dx, dy = cxs[i] - cxs[j], cys[i] - cys[j]
+                dist = dx * dx + dy * dy
+                if is_zero(dist):
+                    d = randint(0, 3)
+                    dx, dy, dist = ux[d], uy[d], 1.0
+                scale = coeff_1 / (dist * sqrt(dist))
+                vxs[i] += dx * scale
+                vys[i] += dy * scale
+                vxs[j] -= dx * scale
+                vys[j] -= dy * scale
+
+        for i, cell in enumerate(active_cells):
+            vx, vy = vxs[i], vys[i]
+            length = sqrt(vx * vx + vy * vy)
+            if not is_zero(length):
+                vx, vy = vx * coeff_2 / length, vy * coeff_2 / length
+            cell.x = xs[i] + int(round(vx))
+            cell.y = ys[i] + int(round(vy))
 
     def _select_rooms(self):
         w_thresh, h_thresh = self._min_room_width, self._min_room_height
@@ -591,7 +955,7 @@ class Dungeon:
 
         # construct a graph of all of the rooms' centers using Delaunay
         # Triangulation (i.e. Delaunay Graph)
-        graph = DelaunayGraph(centers)
+        graph = BowyerWatsonGraph(centers)
         adjlist = graph.adjacency_list()
 
         # calculate MST of the graph
@@ -659,18 +1023,18 @@ class Dungeon:
 
         x, y = cent1.x, cent1.y
         while x <= cent2.x:
-            self._rep_mat[y][x] = Dungeon.TILE_CORR
+            self._rep_mat.set(x, y, Dungeon.TILE_CORR)
             x += 1
 
         if cent1.y > cent2.y:
             x, y = cent2.x, cent2.y
             while y <= cent1.y:
-                self._rep_mat[y][x] = Dungeon.TILE_CORR
+                self._rep_mat.set(x, y, Dungeon.TILE_CORR)
                 y += 1
         else:
             x, y = cent2.x, cent1.y
             while y <= cent2.y:
-                self._rep_mat[y][x] = Dungeon.TILE_CORR
+                self._rep_mat.set(x, y, Dungeon.TILE_CORR)
                 y += 1
 
     def _clear_cells(self):
@@ -678,7 +1042,7 @@ class Dungeon:
             # test if a cell intersects with any hallway
             for y in xrange(cell.y, cell.y + cell.h):
                 for x in xrange(cell.x, cell.x + cell.w):
-                    if self._rep_mat[y][x] == Dungeon.TILE_CORR:
+                    if self._rep_mat.get(x, y) == Dungeon.TILE_CORR:
                         return True
             return False
 
@@ -690,38 +1054,33 @@ class Dungeon:
 
     def _mark_out_rooms(self):
         for room in self._rooms:
-            for y in xrange(room.y, room.y + room.h):
-                for x in xrange(room.x, room.x + room.w):
-                    self._rep_mat[y][x] = Dungeon.TILE_ROOM
+            self._rep_mat.fill_rect(room.x, room.y, room.w, room.h, Dungeon.TILE_ROOM)
 
     def _mark_out_cells(self):
         for cell in self._cells:
-            for y in xrange(cell.y, cell.y + cell.h):
-                for x in xrange(cell.x, cell.x + cell.w):
-                    self._rep_mat[y][x] = Dungeon.TILE_CELL
+            self._rep_mat.fill_rect(cell.x, cell.y, cell.w, cell.h, Dungeon.TILE_CELL)
 
     def print_(self):
         if not self._rep_mat:
             raise Exception('You _SHOULD_ call generate() first')
 
-        def __symbol(type):
-            if type == Dungeon.TILE_ROOM:
-                return 'x'
-            if type == Dungeon.TILE_CELL:
-                return '+'
-            if type == Dungeon.TILE_CORR:
-                return '#'
-            if type == Dungeon.TILE_ROCK:
-                return ' '
-            raise Exception('Undefined dungeon tile')
-
-        output = ''
-        for y in xrange(self._height):
-            for x in xrange(self._width):
-                output += __symbol(self._rep_mat[y][x])
-            output += '\n'
-
-        print output
+        self.write_to(sys.stdout)
+        print
+
+    def write_to(self, fileobj):
+        # write the dungeon out as text, a row at a time
+        if not self._rep_mat:
+            raise Exception('You _SHOULD_ call generate() first')
+        Dungeon._RENDERER.write_to(self._rep_mat, fileobj)
+
+    def save(self, path, seed=None):
+        # write the dungeon to a binary map file (see map_file.py); the
+        # parameters recorded are the settings the dungeon was made with
+        if not self._rep_mat:
+            raise Exception('You _SHOULD_ call generate() first')
+        from map_file import write_map
+        write_map(path, self._rep_mat, (), 'tinykeep_dungeon', seed,
+                  self._settings.as_dict())
 
 #__________________________________________________________________________
 # Code for Testing